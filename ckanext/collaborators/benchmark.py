@@ -0,0 +1,335 @@
+# encoding: utf-8
+'''Benchmarks for the collaborators hot paths
+
+A synthetic set of organizations, users, datasets, resources and
+collaborators is written to the database, the hot paths are timed against
+it and everything is removed afterwards. Run it against a development
+database, never a production one.
+'''
+
+import json
+import time
+import random
+import datetime
+import logging
+from collections import OrderedDict
+
+from ckan import model
+from ckan.plugins import toolkit, get_plugin
+
+from ckanext.collaborators.model import (
+    DatasetMember, DatasetMemberEffective, ResourceVisibility, make_uuid,
+    import_members, refresh_effective, sync_resource_visibility)
+from ckanext.collaborators.cache import labels_cache, reset_request_caches
+from ckanext.collaborators.instrumentation import StatementCounter
+
+log = logging.getLogger(__name__)
+
+
+PREFIX = u'collaborators-benchmark-'
+CHUNK_SIZE = 1000
+
+
+def _chunks(items, size=CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _insert(mapper, rows):
+    for chunk in _chunks(rows):
+        model.Session.bulk_insert_mappings(mapper, chunk)
+
+
+class Seed(object):
+    '''The synthetic objects written to the database for a benchmark run'''
+
+    def __init__(self, datasets, users, orgs, members, rng):
+        self.rng = rng
+        now = datetime.datetime.utcnow()
+        # Leftovers of an interrupted run do not clash with the new names
+        prefix = u'{}{}-'.format(PREFIX, make_uuid()[:8])
+
+        self.org_ids = [make_uuid() for i in range(orgs)]
+        self.user_ids = [make_uuid() for i in range(users)]
+        self.user_names = dict(
+            (user_id, u'{}user-{}'.format(prefix, i))
+            for i, user_id in enumerate(self.user_ids))
+        self.dataset_ids = [make_uuid() for i in range(datasets)]
+        self.owner_orgs = dict(
+            (dataset_id, self.org_ids[i % orgs])
+            for i, dataset_id in enumerate(self.dataset_ids))
+        # Each organization gets an admin, cycling through the users if
+        # there are more organizations than users
+        self.org_admins = dict(
+            (org_id, self.user_ids[i % users])
+            for i, org_id in enumerate(self.org_ids))
+
+        _insert(model.Group, [{
+            u'id': org_id,
+            u'name': u'{}org-{}'.format(prefix, i),
+            u'title': u'Benchmark organization {}'.format(i),
+            u'type': u'organization',
+            u'is_organization': True,
+            u'state': u'active',
+            u'approval_status': u'approved',
+            u'created': now,
+        } for i, org_id in enumerate(self.org_ids)])
+
+        _insert(model.User, [{
+            u'id': user_id,
+            u'name': self.user_names[user_id],
+            u'email': u'{}@example.com'.format(self.user_names[user_id]),
+            u'state': u'active',
+            u'sysadmin': False,
+            u'created': now,
+        } for user_id in self.user_ids])
+
+        org_members = [(org_id, user_id, u'admin')
+                       for org_id, user_id in self.org_admins.items()]
+        org_members.extend(
+            (rng.choice(self.org_ids), user_id,
+             rng.choice([u'member', u'editor']))
+            for user_id in self.user_ids[orgs:])
+        _insert(model.Member, [{
+            u'id': make_uuid(),
+            u'group_id': org_id,
+            u'table_id': user_id,
+            u'table_name': u'user',
+            u'capacity': capacity,
+            u'state': u'active',
+        } for org_id, user_id, capacity in org_members])
+
+        _insert(model.Package, [{
+            u'id': dataset_id,
+            u'name': u'{}dataset-{}'.format(prefix, i),
+            u'title': u'Benchmark dataset {}'.format(i),
+            u'type': u'dataset',
+            u'state': u'active',
+            u'private': True,
+            u'owner_org': self.owner_orgs[dataset_id],
+            u'metadata_created': now,
+            u'metadata_modified': now,
+        } for i, dataset_id in enumerate(self.dataset_ids)])
+
+        # Two resources per dataset, the second one restricted to editors
+        self.restricted_resources = {}
+        resources = []
+        for dataset_id in self.dataset_ids:
+            for position, extras in enumerate(
+                    ({}, {u'visibility': u'editor'})):
+                resource_id = make_uuid()
+                self.restricted_resources[dataset_id] = resource_id
+                resources.append({
+                    u'id': resource_id,
+                    u'package_id': dataset_id,
+                    u'url': u'http://example.com/data.csv',
+                    u'position': position,
+                    u'state': u'active',
+                    u'extras': extras,
+                    u'created': now,
+                })
+        _insert(model.Resource, resources)
+
+        collaborators = {}
+        while len(collaborators) < min(members, datasets * users):
+            dataset_id = rng.choice(self.dataset_ids)
+            # The first one is a user, so there is always one to pick
+            if collaborators and rng.random() < 0.1:
+                key = (dataset_id, u'org', rng.choice(self.org_ids))
+                collaborators[key] = rng.choice([u'member', u'inherit'])
+            else:
+                key = (dataset_id, u'user', rng.choice(self.user_ids))
+                collaborators[key] = rng.choice([u'member', u'editor'])
+        self.user_members = [
+            key for key in collaborators if key[1] == u'user']
+        for chunk in _chunks(collaborators.items()):
+            import_members([{
+                u'dataset_id': dataset_id,
+                u'type': member_type,
+                u'member_id': member_id,
+                u'capacity': capacity,
+            } for (dataset_id, member_type, member_id), capacity in chunk])
+
+        for chunk in _chunks(self.dataset_ids):
+            sync_resource_visibility(chunk)
+            refresh_effective(dataset_ids=chunk)
+        model.repo.commit()
+
+    def remove(self):
+        '''Delete everything created by the seed'''
+        for chunk in _chunks(self.dataset_ids):
+            for table_class, column in (
+                    (DatasetMember, DatasetMember.dataset_id),
+                    (DatasetMemberEffective, DatasetMemberEffective.dataset_id),
+                    (ResourceVisibility, ResourceVisibility.package_id),
+                    (model.Resource, model.Resource.package_id),
+                    (model.Package, model.Package.id)):
+                model.Session.query(table_class).filter(
+                    column.in_(chunk)).delete(synchronize_session=False)
+        for chunk in _chunks(self.user_ids):
+            model.Session.query(model.Member).filter(
+                model.Member.table_id.in_(chunk)).delete(
+                    synchronize_session=False)
+            model.Session.query(model.User).filter(
+                model.User.id.in_(chunk)).delete(synchronize_session=False)
+        model.Session.query(model.Group).filter(
+            model.Group.id.in_(self.org_ids)).delete(synchronize_session=False)
+        model.repo.commit()
+
+    def collaborator_user(self):
+        '''Return the name of a random user collaborator, and a dataset of
+        theirs'''
+        dataset_id, member_type, member_id = self.rng.choice(
+            self.user_members)
+        return self.user_names[member_id], dataset_id
+
+
+def _hot_paths(seed):
+    '''Return a dict of functions, each running one of the hot paths once
+
+    Each call picks its own random dataset or user, and starts with cold
+    caches and a fresh context so nothing is reused between calls.
+    '''
+    plugin = get_plugin('collaborators')
+
+    def collaborator_list():
+        dataset_id = seed.rng.choice(seed.dataset_ids)
+        admin = seed.user_names[seed.org_admins[seed.owner_orgs[dataset_id]]]
+        toolkit.get_action('dataset_collaborator_list')(
+            {'user': admin}, {'id': dataset_id})
+
+    def collaborator_list_for_user():
+        user_name, _ = seed.collaborator_user()
+        toolkit.get_action('dataset_collaborator_list_for_user')(
+            {'user': user_name}, {'id': user_name})
+
+    def auth_package_update():
+        user_name, dataset_id = seed.collaborator_user()
+        try:
+            toolkit.check_access(
+                'package_update', {'user': user_name}, {'id': dataset_id})
+        except toolkit.NotAuthorized:
+            pass
+
+    def auth_resource_show():
+        user_name, dataset_id = seed.collaborator_user()
+        resource_id = seed.restricted_resources[dataset_id]
+        try:
+            toolkit.check_access(
+                'resource_show', {'user': user_name}, {'id': resource_id})
+        except toolkit.NotAuthorized:
+            pass
+
+    def user_dataset_labels():
+        user_name, _ = seed.collaborator_user()
+        plugin.get_user_dataset_labels(model.User.by_name(user_name))
+
+    return OrderedDict([
+        ('dataset_collaborator_list', collaborator_list),
+        ('dataset_collaborator_list_for_user', collaborator_list_for_user),
+        ('auth.package_update', auth_package_update),
+        ('auth.resource_show', auth_resource_show),
+        ('get_user_dataset_labels', user_dataset_labels),
+    ])
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def measure(func, iterations):
+    '''Call func `iterations` times, returning the latency percentiles (in
+    milliseconds) and the average number of SQL statements per call'''
+    timings = []
+    queries = 0
+    for i in range(iterations):
+        labels_cache().clear()
+        reset_request_caches()
+        model.Session.remove()
+
+        with StatementCounter() as counter:
+            start = time.time()
+            func()
+            timings.append((time.time() - start) * 1000)
+        queries += counter.statements
+
+    return OrderedDict([
+        ('p50_ms', round(_percentile(timings, 50), 3)),
+        ('p90_ms', round(_percentile(timings, 90), 3)),
+        ('p99_ms', round(_percentile(timings, 99), 3)),
+        ('mean_ms', round(sum(timings) / len(timings), 3)),
+        ('queries', round(float(queries) / iterations, 2)),
+    ])
+
+
+def run(scales=(1,), datasets=1000, users=500, orgs=20, members=5000,
+        iterations=50, seed=0):
+    '''Seed the database at each scale and time all the hot paths
+
+    The numbers of datasets, users, organizations and collaborators are
+    multiplied by each of the scales in turn.
+
+    Returns a dict with the results of each scale and hot path.
+
+    :raises: ValueError if there is not at least one dataset, user,
+        organization, collaborator and iteration to run
+    '''
+    if min(datasets, users, orgs, members, iterations, *scales) < 1:
+        raise ValueError(u'The number of datasets, users, organizations, '
+                         u'collaborators and iterations, and the scales, '
+                         u'must be at least 1')
+
+    results = OrderedDict()
+    for scale in scales:
+        rng = random.Random(seed)
+        counts = dict(datasets=datasets * scale, users=users * scale,
+                      orgs=max(orgs * scale, 1), members=members * scale)
+        log.info(u'Seeding {datasets} datasets, {users} users, {orgs} '
+                 u'organizations and {members} collaborators'.format(**counts))
+
+        data = Seed(rng=rng, **counts)
+        try:
+            results[str(scale)] = OrderedDict(
+                [('counts', counts)] +
+                [(name, measure(func, iterations))
+                 for name, func in _hot_paths(data).items()])
+        finally:
+            model.Session.remove()
+            data.remove()
+
+    return OrderedDict([
+        ('created', datetime.datetime.utcnow().isoformat()),
+        ('iterations', iterations),
+        ('results', results),
+    ])
+
+
+def compare(results, baseline, threshold=0.2):
+    '''Compare the median latencies of two runs
+
+    Returns a list of (scale, hot path, baseline p50, current p50, ratio,
+    regressed) tuples for the hot paths present in both runs. A hot path
+    regressed if its median latency grew by more than `threshold`.
+    '''
+    out = []
+    for scale, paths in results['results'].items():
+        for name, current in paths.items():
+            previous = baseline['results'].get(scale, {}).get(name)
+            if name == 'counts' or not previous:
+                continue
+            ratio = current['p50_ms'] / max(previous['p50_ms'], 0.001)
+            out.append((scale, name, previous['p50_ms'], current['p50_ms'],
+                        ratio, ratio > 1 + threshold))
+    return out
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
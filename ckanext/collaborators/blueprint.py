@@ -115,37 +115,43 @@ class CollaboratorEditView(MethodView):
         member_type = toolkit.request.params.get(u'type')
         member_id = toolkit.request.params.get(u'member_id')
 
-        collaborators = toolkit.get_action('dataset_collaborator_list')(context, data_dict)
-
-        for c in collaborators:
-            if c['member_id'] == member_id:
-                capacity = c['capacity']
+        if member_type in ('user', 'org'):
+            try:
+                member = toolkit.get_action('dataset_collaborator_show')(
+                    context, {'id': g.pkg_dict['id'], 'type': member_type,
+                              'member_id': member_id})
+            except toolkit.ObjectNotFound as e:
+                return toolkit.abort(404, toolkit._(e.message))
+            except toolkit.ValidationError:
+                return toolkit.abort(400, toolkit._(u'Invalid collaborator'))
 
         if member_type == 'user':
-            user_dict = toolkit.get_action('user_show')(context, {'id': member_id})
+            user_obj = model.User.get(member_id)
             extra_vars = {
                 'type': 'user',
-                'member_name': user_dict.get('name'),
+                'member_id': member_id,
+                'member_name': user_obj.name if user_obj else member_id,
                 'capacities': [ {'name': 'editor', 'value': 'editor'},
                                 {'name': 'member', 'value': 'member'} ],
-                'capacity': capacity}
+                'user_capacity': member['capacity']}
 
         elif member_type == 'org':
-            org_dict = toolkit.get_action('organization_show')(context, {'id': member_id})
+            org_obj = model.Group.get(member_id)
             extra_vars = {
                 'type': 'org',
-                'member_name': org_dict.get('name'),
+                'member_id': member_id,
+                'member_name': org_obj.name if org_obj else member_id,
                 'capacities': [ {'name': 'editor', 'value': 'editor'},
                                 {'name': 'member', 'value': 'member'},
                                 ],
-                'capacity': capacity}
+                'user_capacity': member['capacity']}
 
         else:
             extra_vars = {
                 'capacities': [{'name': 'editor', 'value': 'editor'},
                                {'name': 'member', 'value': 'member'},
                                {'name': 'inherit', 'value': 'inherit'}],
-                'capacity': 'member'}
+                'user_capacity': 'member'}
 
 
         return toolkit.render('collaborator/collaborator_new.html', extra_vars)
@@ -0,0 +1,397 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import flask
+
+from ckan.plugins import toolkit
+
+from ckanext.collaborators.model import (
+    is_collaborator, user_memberships, org_user_ids, dataset_owner_org)
+
+log = logging.getLogger(__name__)
+
+
+def _request_store():
+    '''Return the object holding data for the current Flask or Pylons request
+
+    Returns None when called outside a request (eg from a command or a
+    background job), in which case nothing is cached. Commands register a
+    Pylons context object for the whole process, so the Pylons one is only
+    used while a Pylons request is registered too.
+    '''
+    if flask.has_request_context():
+        return flask.g
+    try:
+        from pylons import request, tmpl_context
+        request._current_obj()
+        return tmpl_context._current_obj()
+    except (ImportError, TypeError):
+        return None
+
+
+def request_cache(name):
+    '''Return a dict stored on the current request, or None outside one'''
+    store = _request_store()
+    if store is None:
+        return None
+    attr = '_collaborators_' + name
+    data = getattr(store, attr, None)
+    if data is None:
+        data = {}
+        setattr(store, attr, data)
+    return data
+
+
+def _request_memberships():
+    return request_cache('memberships')
+
+
+def get_user_memberships(user_id):
+    '''Return a dict mapping dataset ids to the capacities the user holds
+
+    Memberships are resolved once per request and served from memory to
+    every later auth function or helper call for the same user. They are
+    never kept between requests, so authorization checks always see the
+    current memberships.
+    '''
+    cached = _request_memberships()
+    if cached is not None and user_id in cached:
+        return cached[user_id]
+
+    memberships = {}
+    for dataset_id, capacity in user_memberships(user_id):
+        memberships.setdefault(dataset_id, set()).add(capacity)
+
+    if cached is not None:
+        cached[user_id] = memberships
+    return memberships
+
+
+def get_dataset_owner_org(id_or_name):
+    '''Return the owner organization id of a dataset, or None
+
+    Only the id and owner_org columns are read, and the result is kept for
+    the rest of the request.
+
+    :raises: ObjectNotFound if the dataset does not exist
+    '''
+    cached = request_cache('owner_orgs')
+    if cached is not None and id_or_name in cached:
+        return cached[id_or_name]
+
+    row = dataset_owner_org(id_or_name)
+    if row is None:
+        raise toolkit.ObjectNotFound('Dataset not found')
+
+    dataset_id, dataset_name, owner_org = row
+    if cached is not None:
+        cached[dataset_id] = cached[dataset_name] = owner_org
+    return owner_org
+
+
+def user_has_capacity(user_id, dataset_id, capacities):
+    '''Return True if the user holds one of the capacities on the dataset
+
+    Inside a request the user memberships are loaded (once) and checked in
+    memory, otherwise a single point query is run.
+    '''
+    if _request_memberships() is None:
+        return is_collaborator(user_id, dataset_id, capacities)
+
+    held = get_user_memberships(user_id).get(dataset_id, ())
+    return any(capacity in held for capacity in capacities)
+
+
+def reset_request_caches():
+    '''Drop everything cached for the current request'''
+    store = _request_store()
+    if store is None:
+        return
+    for attr in dir(store):
+        if attr.startswith('_collaborators_'):
+            delattr(store, attr)
+
+
+class CacheBackend(object):
+    '''Interface for the caches shared between requests
+
+    Values must be JSON serializable, as they might be stored outside the
+    current process.
+
+    Each key has a version stored in Redis and shared by all the workers,
+    which is bumped when the key is invalidated. Entries are stored with the
+    version read before their value was computed, and are ignored once it
+    changes. This way an invalidation made by any worker is seen by all the
+    others, and a value computed from data read before an invalidation is
+    not served for long after it.
+
+    Redis errors are logged and turn lookups into misses, so the cache is
+    bypassed rather than failing the request.
+    '''
+
+    def __init__(self, namespace, ttl, client=None):
+        self.prefix = u'ckanext-collaborators:{}:'.format(namespace)
+        self.ttl = ttl
+        self._client = client
+        self._last_error = 0
+
+    def _redis_error(self, message):
+        # Do not flood the logs while Redis is down
+        if time.time() - self._last_error > 60:
+            log.exception(message)
+            self._last_error = time.time()
+
+    @property
+    def client(self):
+        if self._client is None:
+            from ckan.lib.redis import connect_to_redis
+            self._client = connect_to_redis()
+        return self._client
+
+    def _version_key(self, key):
+        return self.prefix + u'version:' + key
+
+    def _version(self, key):
+        '''Return the current version of a key, or None if Redis failed'''
+        try:
+            return int(self.client.get(self._version_key(key)) or 0)
+        except Exception:
+            self._redis_error(u'Could not read the version of cache entries')
+            return None
+
+    def invalidate(self, *keys):
+        '''Make the entries of these keys stale, in all the workers
+
+        This runs after changes are committed, so Redis errors are only
+        logged.
+        '''
+        if not keys:
+            return
+        try:
+            pipe = self.client.pipeline()
+            for key in keys:
+                # Versions outlive the entries stored with them
+                pipe.incr(self._version_key(key))
+                pipe.expire(self._version_key(key), self.ttl * 2)
+            pipe.execute()
+        except Exception:
+            log.exception(u'Could not invalidate cache entries {}'.format(
+                u', '.join(keys)))
+
+    def get(self, key):
+        '''Return a (value, version) tuple, value being None on a miss
+
+        The version must be passed to `set` when storing the value computed
+        after a miss. It is None if it could not be read, in which case
+        nothing is stored.
+        '''
+        raise NotImplementedError
+
+    def set(self, key, value, version):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        '''Return a dict with the cache counters'''
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    '''An in-process, thread-safe, size-bounded cache whose entries expire
+    after `ttl` seconds
+
+    Entries are served from memory, and their version is only checked
+    against Redis when they were not checked in the last `check_interval`
+    seconds. Invalidations made by other workers are seen after that long
+    at most, those made by this one straight away.
+    '''
+
+    def __init__(self, namespace, size, ttl, check_interval=5, client=None):
+        super(LRUCache, self).__init__(namespace, ttl, client)
+        self.size = size
+        self.check_interval = check_interval
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        # Entries are (expires, version, value, checked) tuples
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if (entry is not None and entry[0] >= now
+                    and now - entry[3] < self.check_interval):
+                # Re-insert to mark it as the most recently used
+                self._data[key] = self._data.pop(key)
+                self.hits += 1
+                return entry[2], entry[1]
+
+        version = self._version(key)
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if (version is None or entry is None or entry[0] < now
+                    or entry[1] != version):
+                self.misses += 1
+                return None, version
+            self._data[key] = (entry[0], entry[1], entry[2], now)
+            self.hits += 1
+            return entry[2], version
+
+    def set(self, key, value, version):
+        if self.size <= 0 or version is None:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            # Not marked as checked, the version might have changed while
+            # the value was computed
+            self._data[key] = (time.time() + self.ttl, version, value, 0)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+        super(LRUCache, self).invalidate(*keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'size': len(self._data),
+                'max_size': self.size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class RedisCache(CacheBackend):
+    '''A cache stored in Redis, shared by all the workers using it
+
+    Size is bounded by the Redis eviction policy rather than by the cache
+    itself.
+    '''
+
+    def __init__(self, namespace, ttl, client=None):
+        super(RedisCache, self).__init__(namespace, ttl, client)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value, version = self.client.mget(
+                [self.prefix + u'entry:' + key, self._version_key(key)])
+        except Exception:
+            self._redis_error(u'Could not read cache entries')
+            self.misses += 1
+            return None, None
+        version = int(version or 0)
+        entry = json.loads(value) if value is not None else None
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None, version
+        self.hits += 1
+        return entry[1], version
+
+    def set(self, key, value, version):
+        if version is None:
+            return
+        try:
+            self.client.setex(
+                self.prefix + u'entry:' + key, self.ttl,
+                json.dumps([version, value]))
+        except Exception:
+            self._redis_error(u'Could not store cache entries')
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + u'entry:*'))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+_caches = {}
+
+
+def _get_cache(namespace):
+    if namespace not in _caches:
+        config = toolkit.config
+        backend = config.get('ckanext.collaborators.cache.backend', 'memory')
+        ttl = toolkit.asint(config.get(
+            'ckanext.collaborators.{}_cache.ttl'.format(namespace), 300))
+        if backend == 'redis':
+            _caches[namespace] = RedisCache(namespace, ttl)
+        elif backend == 'memory':
+            _caches[namespace] = LRUCache(
+                namespace,
+                size=toolkit.asint(config.get(
+                    'ckanext.collaborators.{}_cache.size'.format(namespace),
+                    1000)),
+                ttl=ttl,
+                check_interval=toolkit.asint(config.get(
+                    'ckanext.collaborators.{}_cache.check_interval'.format(
+                        namespace), 5)))
+        else:
+            raise ValueError(
+                u'Unknown ckanext.collaborators.cache.backend: {}'.format(
+                    backend))
+    return _caches[namespace]
+
+
+def labels_cache():
+    '''Return the cache of user dataset labels'''
+    return _get_cache('labels')
+
+
+def invalidate_member(member_type, member_id):
+    '''Drop every cached entry affected by a change to a collaborator
+
+    For organizations, the entries of all the organization users are
+    dropped.
+    '''
+    invalidate_members([(member_type, member_id)])
+
+
+def invalidate_members(members):
+    '''Drop the cached entries affected by changes to many collaborators
+
+    Changes to organizations affect their current users as well as the ones
+    just removed from them, so the entries of both are dropped.
+
+    :param members: (type, member_id) tuples
+    '''
+    members = set(members)
+    if not members:
+        return
+    # Memberships, owner organizations and resource visibility cached for
+    # the current request might all be affected
+    reset_request_caches()
+
+    user_ids = set()
+    for member_type, member_id in members:
+        if member_type == 'org':
+            user_ids.update(org_user_ids(member_id))
+        else:
+            user_ids.add(member_id)
+    labels_cache().invalidate(*user_ids)
@@ -1,11 +1,68 @@
 # encoding: utf-8
 
+import csv
 import sys
+import json
+import time
 import logging
+from collections import OrderedDict
 
 from ckan.plugins.toolkit import CkanCommand
 
-from ckanext.collaborators.model import tables_exist, create_tables, drop_tables
+from ckan import model
+
+from ckanext.collaborators.model import (
+    tables_exist, create_tables, drop_tables, missing_tables,
+    missing_indexes, duplicate_members, create_indexes, refresh_effective,
+    sync_resource_visibility, DatasetMemberEffective, ResourceVisibility,
+    ids_by_id_or_name, import_members, export_members,
+    orphaned_member_counts, delete_orphaned_members,
+    delete_orphaned_visibility)
+from ckanext.collaborators.logic.action import (
+    ALLOWED_MEMBER_TYPES, ALLOWED_USER_CAPACITIES, ALLOWED_ORG_CAPACITIES)
+from ckanext.collaborators.cache import invalidate_members
+
+
+def _read_rows(stream, file_format):
+    '''Yield a (line number, row dict) tuple for each row of a CSV or JSONL
+    stream. Rows that can not be parsed are returned as None.'''
+    if file_format == u'jsonl':
+        for line_number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
+    else:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, dict(
+                (key, value.decode('utf-8'))
+                for key, value in row.items() if key and value is not None)
+
+
+def _row_error(row):
+    '''Return the error of a row that can not be imported at all, or None'''
+    if row is None:
+        return u'Could not parse row'
+    for field in (u'id', u'type', u'member_id', u'capacity'):
+        value = row.get(field)
+        if value is not None and not isinstance(value, basestring):
+            return u'"{}" must be a string'.format(field)
+    return None
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 class DatasetCollaborators(CkanCommand):
@@ -15,6 +72,54 @@ class DatasetCollaborators(CkanCommand):
         paster collaborators init-db
             Initialize database tables
 
+        paster collaborators upgrade-db
+            Add any missing table or index, on a new or an existing install.
+            Indexes are built concurrently so the tables stay available for
+            writes
+
+        paster collaborators rebuild-effective
+            Recompute the effective permissions of all collaborators
+
+        paster collaborators backfill-visibility
+            Index the visibility of all existing resources
+
+        paster collaborators retry-notifications
+            Queue again the email notifications that could not be sent
+
+        paster collaborators send-digests
+            Queue the notification digests if their window has elapsed. Run
+            it periodically (eg every minute from cron) in digest mode
+
+        paster collaborators import [FILE] [--format=csv|jsonl] [--dry-run]
+                                           [--chunk-size=N]
+            Add or update collaborators from a CSV or JSONL file, or from
+            stdin if no file is given. Each row needs the dataset "id" (or
+            name), the member "type" (user or org, defaults to user), the
+            "member_id" (or name) and the "capacity". With --dry-run, the
+            changes are reported but not saved
+
+        paster collaborators export [FILE] [--format=csv|jsonl] [--names]
+                                           [--org=ORG] [--dataset=DATASET]
+                                           [--type=TYPE] [--capacity=CAPACITY]
+            Write all collaborators, or the ones matching the filters, to a
+            CSV or JSONL file, or to stdout if no file is given. --org
+            selects the datasets owned by an organization, and --dataset can
+            be repeated. With --names, the dataset and member names are
+            included as well
+
+        paster collaborators prune [--dry-run] [--chunk-size=N]
+            Remove the collaborators of purged datasets, as well as deleted
+            users and organizations. With --dry-run, they are only counted
+
+        paster collaborators benchmark [--scales=1,10] [--num-datasets=N]
+                                       [--num-users=N] [--num-orgs=N]
+                                       [--num-members=N] [--iterations=N]
+                                       [--output=FILE] [--compare=FILE]
+            Time the collaborators hot paths against synthetic data, which
+            is removed afterwards. Only run it on a development database.
+            Results can be saved as a baseline, and compared with a
+            previous one
+
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
@@ -25,16 +130,83 @@ class DatasetCollaborators(CkanCommand):
 
         super(DatasetCollaborators, self).__init__(name)
 
+        self.parser.add_option(
+            '--format', dest='format', choices=['csv', 'jsonl'],
+            help='Format of the file, guessed from its extension by default')
+        self.parser.add_option(
+            '--dry-run', dest='dry_run', action='store_true', default=False,
+            help='Do not save any change')
+        self.parser.add_option(
+            '--chunk-size', dest='chunk_size', type='int', default=5000,
+            help='Rows processed per transaction or fetched at a time')
+        self.parser.add_option(
+            '--names', dest='names', action='store_true', default=False,
+            help='Include dataset and member names in the export')
+        self.parser.add_option(
+            '--org', dest='org',
+            help='Only export collaborators of datasets of this organization')
+        self.parser.add_option(
+            '--dataset', dest='datasets', action='append',
+            help='Only export collaborators of this dataset')
+        self.parser.add_option(
+            '--type', dest='member_type', choices=['user', 'org'],
+            help='Only export collaborators of this type')
+        self.parser.add_option(
+            '--capacity', dest='capacity',
+            help='Only export collaborators with this capacity')
+        self.parser.add_option(
+            '--scales', dest='scales', default='1',
+            help='Comma separated multipliers of the benchmark data sizes')
+        self.parser.add_option(
+            '--num-datasets', dest='num_datasets', type='int', default=1000)
+        self.parser.add_option(
+            '--num-users', dest='num_users', type='int', default=500)
+        self.parser.add_option(
+            '--num-orgs', dest='num_orgs', type='int', default=20)
+        self.parser.add_option(
+            '--num-members', dest='num_members', type='int', default=5000,
+            help='Number of collaborators')
+        self.parser.add_option(
+            '--iterations', dest='iterations', type='int', default=50,
+            help='Calls timed per hot path and scale')
+        self.parser.add_option(
+            '--output', dest='output',
+            help='Save the benchmark results as JSON to this file')
+        self.parser.add_option(
+            '--compare', dest='compare',
+            help='Compare the benchmark results with a saved baseline')
+        self.parser.add_option(
+            '--threshold', dest='threshold', type='float', default=0.2,
+            help='Slowdown ratio reported as a regression')
+
     def command(self):
         self._load_config()
 
-        if len(self.args) != 1:
+        if not self.args:
             self.parser.print_usage()
             sys.exit(1)
 
         cmd = self.args[0]
         if cmd == 'init-db':
             self.init_db()
+        elif cmd == 'upgrade-db':
+            self.upgrade_db()
+        elif cmd == 'rebuild-effective':
+            self.rebuild_effective()
+        elif cmd == 'backfill-visibility':
+            self.backfill_visibility()
+        elif cmd == 'retry-notifications':
+            self.retry_notifications()
+        elif cmd == 'send-digests':
+            self.send_digests()
+        elif cmd == 'import':
+            self.import_collaborators()
+        elif cmd == 'export':
+            self.export_collaborators()
+        elif cmd == 'prune':
+            self.prune()
+        elif cmd == 'benchmark':
+            self.benchmark()
         elif cmd == 'remove-db':
             self.remove_db()
         elif cmd == 'reset-db':
@@ -55,6 +227,314 @@ class DatasetCollaborators(CkanCommand):
 
         print(u'Dataset collaborators tables created')
 
+    def upgrade_db(self):
+
+        tables = missing_tables()
+        if not tables and not missing_indexes():
+            print(u'Dataset collaborators tables are up to date')
+            sys.exit(0)
+
+        for table in tables:
+            table.create()
+            print(u'Table {} created'.format(table.name))
+
+        if DatasetMemberEffective.__table__ in tables:
+            self.rebuild_effective()
+        if ResourceVisibility.__table__ in tables:
+            self.backfill_visibility()
+
+        duplicates = duplicate_members()
+        if duplicates:
+            print(u'The following collaborators are stored more than once, '
+                  u'please remove the duplicates before upgrading:')
+            for dataset_id, member_type, member_id in duplicates:
+                print(u'    {} {} in dataset {}'.format(
+                    member_type, member_id, dataset_id))
+            sys.exit(1)
+
+        for name in create_indexes():
+            print(u'Index {} created'.format(name))
+
+        print(u'Dataset collaborators tables upgraded')
+
+    def rebuild_effective(self):
+
+        refresh_effective()
+        model.repo.commit()
+
+        print(u'Dataset collaborators effective permissions rebuilt')
+
+    def backfill_visibility(self):
+
+        count = sync_resource_visibility()
+        model.repo.commit()
+
+        print(u'Visibility of {} restricted resources indexed'.format(count))
+
+    def retry_notifications(self):
+        from ckanext.collaborators.jobs import retry_failed_notifications
+
+        count = retry_failed_notifications()
+
+        print(u'{} failed notifications queued again'.format(count))
+
+    def send_digests(self):
+        from ckanext.collaborators.jobs import flush_digests
+
+        if flush_digests():
+            print(u'Notification digests queued')
+        else:
+            print(u'No notification digests due')
+
+    def import_collaborators(self):
+
+        path = self.args[1] if len(self.args) > 1 else u'-'
+        file_format = self.options.format or (
+            u'jsonl' if path.endswith((u'.jsonl', u'.json')) else u'csv')
+
+        totals = dict(read=0, inserted=0, updated=0, errors=0)
+        start = time.time()
+
+        stream = sys.stdin if path == u'-' else open(path, 'rb')
+        try:
+            for chunk in _batches(
+                    _read_rows(stream, file_format), self.options.chunk_size):
+                inserted, updated, errors = self._import_chunk(chunk)
+
+                totals['read'] += len(chunk)
+                totals['inserted'] += inserted
+                totals['updated'] += updated
+                totals['errors'] += errors
+
+                print(u'{read} rows read, {inserted} added, {updated} updated, '
+                      u'{errors} errors ({rate:.0f} rows/s)'.format(
+                          rate=totals['read'] / max(time.time() - start, 0.001),
+                          **totals))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        print(u'Import {}: {read} rows in {elapsed:.1f}s, {inserted} '
+              u'collaborators added, {updated} updated, {errors} errors'.format(
+                  u'checked, nothing was saved' if self.options.dry_run
+                  else u'finished',
+                  elapsed=time.time() - start, **totals))
+
+    def _import_chunk(self, chunk):
+        chunk = [(line_number, row, _row_error(row))
+                 for line_number, row in chunk]
+        rows = [row for _, row, error in chunk if not error]
+
+        datasets = ids_by_id_or_name(
+            model.Package.id, model.Package.name,
+            [row.get(u'id') for row in rows])
+        members = {
+            u'user': ids_by_id_or_name(
+                model.User.id, model.User.name,
+                [row.get(u'member_id') for row in rows
+                 if (row.get(u'type') or u'user') == u'user']),
+            u'org': ids_by_id_or_name(
+                model.Group.id, model.Group.name,
+                [row.get(u'member_id') for row in rows
+                 if row.get(u'type') == u'org']),
+        }
+        capacities = {
+            u'user': ALLOWED_USER_CAPACITIES,
+            u'org': ALLOWED_ORG_CAPACITIES,
+        }
+
+        to_store = OrderedDict()
+        errors = 0
+        for line_number, row, error in chunk:
+            if not error:
+                member_type = row.get(u'type') or u'user'
+                dataset_id = datasets.get(row.get(u'id'))
+                member_id = members.get(member_type, {}).get(
+                    row.get(u'member_id'))
+                capacity = row.get(u'capacity')
+
+                if member_type not in ALLOWED_MEMBER_TYPES:
+                    error = u'Type must be one of "{}"'.format(
+                        u', '.join(ALLOWED_MEMBER_TYPES))
+                elif not dataset_id:
+                    error = u'Dataset not found: {}'.format(row.get(u'id'))
+                elif not member_id:
+                    error = u'{} not found: {}'.format(
+                        u'User' if member_type == u'user' else u'Organization',
+                        row.get(u'member_id'))
+                elif capacity not in capacities[member_type]:
+                    error = u'Capacity must be one of "{}"'.format(
+                        u', '.join(capacities[member_type]))
+
+            if error:
+                errors += 1
+                sys.stderr.write(u'Line {}: {}\n'.format(
+                    line_number, error).encode('utf-8'))
+                continue
+
+            # The last occurrence of a repeated collaborator wins
+            to_store[(dataset_id, member_type, member_id)] = capacity
+
+        inserted, updated = import_members([{
+            u'dataset_id': dataset_id,
+            u'type': member_type,
+            u'member_id': member_id,
+            u'capacity': capacity,
+            } for (dataset_id, member_type, member_id), capacity
+            in to_store.items()])
+
+        if self.options.dry_run:
+            model.Session.rollback()
+        else:
+            dataset_ids = set(key[0] for key in to_store)
+            refresh_effective(dataset_ids=dataset_ids)
+            model.repo.commit()
+
+            invalidate_members(
+                (member_type, member_id)
+                for _, member_type, member_id in to_store)
+
+        return inserted, updated, errors
+
+    def export_collaborators(self):
+
+        path = self.args[1] if len(self.args) > 1 else u'-'
+        file_format = self.options.format or (
+            u'jsonl' if path.endswith((u'.jsonl', u'.json')) else u'csv')
+
+        owner_org = None
+        if self.options.org:
+            owner_org = ids_by_id_or_name(
+                model.Group.id, model.Group.name,
+                [self.options.org]).get(self.options.org)
+            if not owner_org:
+                sys.stderr.write(u'Organization not found: {}\n'.format(
+                    self.options.org))
+                sys.exit(1)
+
+        dataset_ids = None
+        if self.options.datasets:
+            datasets = ids_by_id_or_name(
+                model.Package.id, model.Package.name, self.options.datasets)
+            missing = [d for d in self.options.datasets if d not in datasets]
+            if missing:
+                sys.stderr.write(u'Datasets not found: {}\n'.format(
+                    u', '.join(missing)))
+                sys.exit(1)
+            dataset_ids = list(set(datasets.values()))
+
+        rows = export_members(
+            dataset_ids=dataset_ids,
+            owner_org=owner_org,
+            member_type=self.options.member_type,
+            capacity=self.options.capacity,
+            names=self.options.names,
+            batch_size=self.options.chunk_size)
+
+        # Same keys as the import command, so exports can be imported again
+        fields = [u'id', u'type', u'member_id', u'capacity', u'modified']
+        if self.options.names:
+            fields.extend([u'dataset_name', u'member_name'])
+
+        start = time.time()
+        count = 0
+        stream = sys.stdout if path == u'-' else open(path, 'wb')
+        try:
+            if file_format == u'csv':
+                writer = csv.writer(stream)
+                writer.writerow(fields)
+            for row in rows:
+                values = [value.isoformat() if hasattr(value, 'isoformat')
+                          else value for value in row]
+                if file_format == u'csv':
+                    writer.writerow([
+                        (value or u'').encode('utf-8') for value in values])
+                else:
+                    stream.write(json.dumps(dict(zip(fields, values))) + '\n')
+                count += 1
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+        sys.stderr.write(u'{} collaborators exported in {:.1f}s\n'.format(
+            count, time.time() - start))
+
+    def prune(self):
+
+        counts = orphaned_member_counts()
+        print(u'{} collaborators of purged datasets, {} deleted users and {} '
+              u'deleted organizations'.format(
+                  counts[u'dataset'], counts[u'user'], counts[u'org']))
+        if self.options.dry_run:
+            return
+
+        total = 0
+        while True:
+            deleted = delete_orphaned_members(limit=self.options.chunk_size)
+            if not deleted:
+                break
+
+            dataset_ids = set(row[0] for row in deleted)
+            refresh_effective(dataset_ids=dataset_ids)
+            model.repo.commit()
+
+            invalidate_members(
+                (row[1], row[2]) for row in deleted)
+
+            total += len(deleted)
+            print(u'{} collaborators removed'.format(total))
+
+        visibility = delete_orphaned_visibility()
+        model.repo.commit()
+
+        print(u'Pruned {} collaborators and the visibility of {} resources'.format(
+            total, visibility))
+
+    def benchmark(self):
+        from ckanext.collaborators import benchmark
+
+        try:
+            results = benchmark.run(
+                scales=[int(scale) for scale in self.options.scales.split(',')],
+                datasets=self.options.num_datasets,
+                users=self.options.num_users,
+                orgs=self.options.num_orgs,
+                members=self.options.num_members,
+                iterations=self.options.iterations)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
+        for scale, paths in results['results'].items():
+            print(u'Scale {} ({datasets} datasets, {users} users, {orgs} '
+                  u'organizations, {members} collaborators)'.format(
+                      scale, **paths['counts']))
+            print(u'    {:<36}{:>10}{:>10}{:>10}{:>10}'.format(
+                u'', u'p50 ms', u'p90 ms', u'p99 ms', u'queries'))
+            for name, stats in paths.items():
+                if name == 'counts':
+                    continue
+                print(u'    {:<36}{p50_ms:>10.2f}{p90_ms:>10.2f}'
+                      u'{p99_ms:>10.2f}{queries:>10.1f}'.format(name, **stats))
+
+        if self.options.output:
+            benchmark.save(results, self.options.output)
+            print(u'Results saved to {}'.format(self.options.output))
+
+        if self.options.compare:
+            regressions = 0
+            print(u'Compared with {}:'.format(self.options.compare))
+            for scale, name, before, after, ratio, regressed in \
+                    benchmark.compare(results,
+                                      benchmark.load(self.options.compare),
+                                      self.options.threshold):
+                regressions += regressed
+                print(u'    {:<6}{:<36}{:>10.2f}{:>10.2f}{:>8.2f}x{}'.format(
+                    scale, name, before, after, ratio,
+                    u'  REGRESSION' if regressed else u''))
+            if regressions:
+                sys.exit(1)
+
     def remove_db(self):
 
         if not tables_exist():
@@ -1,4 +1,8 @@
 import ckan.plugins.toolkit as toolkit
+import ckan.model as model
+
+from ckanext.collaborators.logic.auth import visible_resource_ids
+from ckanext.collaborators.model import dataset_members
 
 def get_collaborators(package_dict, type=None):
     '''Return collaborators list.
@@ -22,6 +26,65 @@ def get_collaborators(package_dict, type=None):
     return collaborators
 
 
+def get_collaborators_for_display(package_dict):
+    '''Return the collaborators of a dataset ready to be rendered
+
+    All collaborators are read with a single query, and the users and
+    organizations they refer to are then loaded with one query each, no
+    matter how many collaborators the dataset has.
+
+    Returns a dict with a 'user' and an 'org' list of (member_id, member,
+    capacity) tuples. User members are User objects that can be passed to
+    h.linked_user, organization members are dicts that can be passed to
+    h.organization_link. Members that no longer exist are returned as their
+    id.
+    '''
+    members = {'user': [], 'org': []}
+    for member_type, member_id, capacity in dataset_members(
+            package_dict['id']):
+        if member_type in members:
+            members[member_type].append((member_id, capacity))
+
+    users = {}
+    user_ids = [member_id for member_id, capacity in members['user']]
+    if user_ids:
+        users = dict((user.id, user) for user in model.Session.query(
+            model.User).filter(model.User.id.in_(user_ids)))
+
+    orgs = {}
+    org_ids = [member_id for member_id, capacity in members['org']]
+    if org_ids:
+        orgs = dict((org.id, {'id': org.id, 'name': org.name,
+                              'title': org.title or org.name})
+                    for org in model.Session.query(
+                        model.Group.id, model.Group.name, model.Group.title).
+                    filter(model.Group.id.in_(org_ids)))
+
+    return {
+        'user': [(member_id, users.get(member_id, member_id), capacity)
+                 for member_id, capacity in members['user']],
+        'org': [(member_id, orgs.get(member_id, member_id), capacity)
+                for member_id, capacity in members['org']],
+    }
+
+
+def get_visible_resources(package_dict):
+    '''Return the resources of the dataset the current user is allowed to see
+
+    All resources are checked at once, and later resource_show checks for
+    them are answered from the same result.
+    '''
+    package_obj = model.Package.get(package_dict['id'])
+    if not package_obj:
+        return []
+
+    context = {'user': toolkit.c.user, 'auth_user_obj': toolkit.c.userobj}
+    visible = visible_resource_ids(context, package_obj)
+
+    return [resource for resource in package_dict.get('resources', [])
+            if resource['id'] in visible]
+
+
 def get_resource_visibility_options():
     return [{'value': 'package', 'text': 'Match Dataset'},
             {'value': 'editor', 'text':'Editor'},
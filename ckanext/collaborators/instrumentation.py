@@ -0,0 +1,149 @@
+# encoding: utf-8
+'''Optional timing and SQL statement counting of the collaborators actions
+and auth functions
+
+Instrumentation is enabled with ``ckanext.collaborators.instrumentation``.
+When it is disabled the plugin registers the original functions, so there
+is no overhead at all.
+'''
+
+import time
+import logging
+import functools
+import threading
+
+from sqlalchemy import event
+
+from ckan import model
+from ckan.plugins import toolkit
+
+log = logging.getLogger(__name__)
+
+
+_local = threading.local()
+_listening = []
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _active_counters():
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    return counters
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    counters = getattr(_local, 'counters', None)
+    if not counters:
+        return
+    # Number of rows returned, or affected by a write. Server-side cursors
+    # report -1 as they have not fetched anything yet
+    rows = max(cursor.rowcount, 0)
+    for counter in counters:
+        counter.statements += 1
+        counter.rows += rows
+
+
+class StatementCounter(object):
+    '''Context manager counting the SQL statements run, and the rows they
+    return, by the current thread while it is active
+
+    Counters can be nested, statements are counted by all the active ones.
+    '''
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+
+    def __enter__(self):
+        if not _listening:
+            event.listen(model.meta.engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+            _listening.append(True)
+        _active_counters().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _active_counters().remove(self)
+
+
+def enabled():
+    return toolkit.asbool(toolkit.config.get(
+        'ckanext.collaborators.instrumentation', False))
+
+
+def _record(name, elapsed, statements, rows):
+    with _stats_lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = {
+                'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                'statements': 0, 'rows': 0}
+        stats['calls'] += 1
+        stats['total_ms'] += elapsed
+        stats['max_ms'] = max(stats['max_ms'], elapsed)
+        stats['statements'] += statements
+        stats['rows'] += rows
+
+
+def get_stats():
+    '''Return the totals and averages recorded for each function called'''
+    with _stats_lock:
+        return dict((name, {
+            'calls': stats['calls'],
+            'total_ms': round(stats['total_ms'], 3),
+            'mean_ms': round(stats['total_ms'] / stats['calls'], 3),
+            'max_ms': round(stats['max_ms'], 3),
+            'statements': stats['statements'],
+            'mean_statements': round(
+                float(stats['statements']) / stats['calls'], 2),
+            'rows': stats['rows'],
+        }) for name, stats in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def instrument(name, func):
+    '''Wrap a function to record its wall time, SQL statements and rows
+
+    Calls slower than ``ckanext.collaborators.instrumentation.slow_ms``
+    milliseconds (default 500) are logged. Attributes of the function, like
+    the ones marking chained or anonymous auth functions, are kept.
+    '''
+    slow_ms = float(toolkit.config.get(
+        'ckanext.collaborators.instrumentation.slow_ms', 500))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with StatementCounter() as counter:
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = (time.time() - start) * 1000
+                _record(name, elapsed, counter.statements, counter.rows)
+                if elapsed >= slow_ms:
+                    log.warning(
+                        u'Slow call to {}: {:.1f}ms, {} SQL statements, '
+                        u'{} rows'.format(
+                            name, elapsed, counter.statements, counter.rows))
+    return wrapper
+
+
+def instrument_all(functions, kind):
+    '''Return the functions instrumented, or unchanged if instrumentation is
+    disabled
+
+    :param functions: dict of action or auth functions, keyed by name
+    :param kind: prefix for the names in the stats, eg 'action' or 'auth'
+    '''
+    if not enabled():
+        return functions
+    return dict(
+        (name, instrument(u'{}.{}'.format(kind, name), func))
+        for name, func in functions.items())
@@ -0,0 +1,238 @@
+import json
+import time
+import logging
+
+from ckan.plugins import toolkit
+from ckan.lib.redis import connect_to_redis
+from ckan.lib.mailer import MailerException
+
+from ckanext.collaborators.mailer import (
+    send_notification_to_collaborator, compose_digest, send_messages)
+
+log = logging.getLogger(__name__)
+
+
+MAIL_FAILED_KEY = u'ckanext-collaborators:mail:failed'
+MAIL_PENDING_USERS_KEY = u'ckanext-collaborators:mail:pending'
+MAIL_PENDING_KEY = u'ckanext-collaborators:mail:pending:{}'
+MAIL_SCHEDULED_KEY = u'ckanext-collaborators:mail:scheduled'
+
+
+def _digest_enabled():
+    return toolkit.asbool(toolkit.config.get(
+        'ckanext.collaborators.notifications.digest', False))
+
+
+def _digest_window():
+    return toolkit.asint(toolkit.config.get(
+        'ckanext.collaborators.notifications.digest_window', 60))
+
+
+def queue_notification(dataset_id, user_id, capacity, event, redis=None):
+    '''Queue an email to a collaborator, to be sent by a background job
+
+    In digest mode, the notifications of each user are collected during the
+    digest window and sent together as a single email.
+
+    Notifications are queued once the change is committed, so errors (eg
+    Redis being down) are logged rather than raised.
+
+    :param event: either 'create' or 'delete'
+    '''
+    if not toolkit.asbool(
+            toolkit.config.get('ckanext.collaborators.notifications', True)):
+        return
+
+    try:
+        _queue_notification(dataset_id, user_id, capacity, event, redis)
+    except Exception:
+        log.exception(u'Error queueing the notification of user {} for '
+                      u'dataset {}'.format(user_id, dataset_id))
+
+
+def _queue_notification(dataset_id, user_id, capacity, event, redis):
+    if not _digest_enabled():
+        toolkit.enqueue_job(
+            send_notification, [dataset_id, user_id, capacity, event],
+            title=u'Notify collaborator {} of dataset {}'.format(
+                user_id, dataset_id))
+        return
+
+    redis = redis or connect_to_redis()
+    pipe = redis.pipeline()
+    pipe.sadd(MAIL_PENDING_USERS_KEY, user_id)
+    pipe.rpush(MAIL_PENDING_KEY.format(user_id), json.dumps({
+        u'dataset_id': dataset_id,
+        u'user_id': user_id,
+        u'capacity': capacity,
+        u'event': event,
+    }))
+    pipe.execute()
+
+    # Remember when the first notification of this digest was queued
+    redis.set(MAIL_SCHEDULED_KEY, time.time(), nx=True)
+    flush_digests(redis)
+
+
+def flush_digests(redis=None):
+    '''Queue a job sending the digests, if the digest window has elapsed
+
+    This is called whenever a notification is queued, and should also be
+    run periodically (eg with the ``send-digests`` command) so the last
+    notifications are sent even if no other change follows them. Jobs never
+    wait for the window themselves, as that would block a worker.
+
+    Returns True if the job was queued.
+    '''
+    redis = redis or connect_to_redis()
+
+    scheduled = redis.get(MAIL_SCHEDULED_KEY)
+    if not scheduled or float(scheduled) + _digest_window() > time.time():
+        return False
+    # Only the process that deletes the key queues the job
+    if not redis.delete(MAIL_SCHEDULED_KEY):
+        return False
+    toolkit.enqueue_job(
+        send_digests, title=u'Send collaborator notification digests')
+    return True
+
+
+def _mail_retries():
+    return toolkit.asint(
+        toolkit.config.get('ckanext.collaborators.mail.retries', 3))
+
+
+def _store_failed(redis, notifications, error):
+    redis = redis or connect_to_redis()
+    redis.rpush(MAIL_FAILED_KEY, *[json.dumps(dict(
+        notification, error=u'{}'.format(error), failed=time.time()))
+        for notification in notifications])
+
+
+def send_notification(dataset_id, user_id, capacity, event, redis=None,
+                      attempt=0):
+    '''Background job emailing a collaborator
+
+    Failed attempts are retried by queueing the job again, so the worker is
+    free to run other jobs meanwhile. If all of them fail, the notification
+    is stored in a dead-letter list in Redis so it can be sent again later
+    with retry_failed_notifications.
+
+    :param attempt: number of previous failed attempts
+    '''
+    try:
+        send_notification_to_collaborator(dataset_id, user_id, capacity, event)
+        return
+    except MailerException as e:
+        error = e
+
+    retries = _mail_retries()
+    if attempt < retries:
+        log.warning(u'Error notifying user {}, retrying: {}'.format(
+            user_id, error))
+        toolkit.enqueue_job(
+            send_notification, [dataset_id, user_id, capacity, event],
+            {u'attempt': attempt + 1},
+            title=u'Notify collaborator {} of dataset {}'.format(
+                user_id, dataset_id))
+        return
+
+    log.error(u'Could not notify user {} after {} attempts: {}'.format(
+        user_id, attempt + 1, error))
+
+    _store_failed(redis, [{
+        u'dataset_id': dataset_id,
+        u'user_id': user_id,
+        u'capacity': capacity,
+        u'event': event,
+    }], error)
+
+
+def _pop_pending(redis):
+    pipe = redis.pipeline()
+    pipe.smembers(MAIL_PENDING_USERS_KEY)
+    pipe.delete(MAIL_PENDING_USERS_KEY)
+    user_ids, _ = pipe.execute()
+
+    pending = {}
+    for user_id in sorted(user_ids):
+        key = MAIL_PENDING_KEY.format(user_id)
+        pipe = redis.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        items, _ = pipe.execute()
+        if items:
+            pending[user_id] = [json.loads(item) for item in items]
+    return pending
+
+
+def send_digests(redis=None, pending=None, attempt=0):
+    '''Background job emailing each user a digest of their notifications
+
+    All digests are sent over the same SMTP connection. Digests that could
+    not be sent are retried like single notifications, and end up in the
+    dead-letter list if all attempts fail.
+
+    :param pending: notifications to send, keyed by user id. By default, all
+        the ones collected since the last digests are sent
+    :param attempt: number of previous failed attempts
+    '''
+    redis = redis or connect_to_redis()
+    if pending is None:
+        pending = _pop_pending(redis)
+
+    digests = []
+    for user_id, notifications in sorted(pending.items()):
+        message = compose_digest(user_id, notifications)
+        if message:
+            digests.append((user_id, message, notifications))
+
+    errors = send_messages([message for _, message, _ in digests])
+    failed = [digests[index] for index in sorted(errors)]
+
+    log.info(u'{} collaborator notification digests sent'.format(
+        len(digests) - len(failed)))
+    if not failed:
+        return
+
+    if attempt < _mail_retries():
+        log.warning(u'Error sending {} digests, retrying'.format(len(failed)))
+        toolkit.enqueue_job(
+            send_digests, kwargs={
+                u'pending': dict((user_id, notifications)
+                                 for user_id, _, notifications in failed),
+                u'attempt': attempt + 1,
+            },
+            title=u'Send collaborator notification digests')
+        return
+
+    for index, (_, message, notifications) in zip(sorted(errors), failed):
+        log.error(u'Could not send digest to {} after {} attempts: {}'.format(
+            message.email, attempt + 1, errors[index]))
+        _store_failed(redis, notifications, errors[index])
+
+
+def failed_notifications(redis=None):
+    '''Return the notifications in the dead-letter list, oldest first'''
+    redis = redis or connect_to_redis()
+    return [json.loads(item) for item in redis.lrange(MAIL_FAILED_KEY, 0, -1)]
+
+
+def retry_failed_notifications(redis=None):
+    '''Queue again all the notifications in the dead-letter list
+
+    Returns the number of notifications queued.
+    '''
+    redis = redis or connect_to_redis()
+
+    pipe = redis.pipeline()
+    pipe.lrange(MAIL_FAILED_KEY, 0, -1)
+    pipe.delete(MAIL_FAILED_KEY)
+    items, _ = pipe.execute()
+
+    for item in items:
+        notification = json.loads(item)
+        queue_notification(
+            notification[u'dataset_id'], notification[u'user_id'],
+            notification[u'capacity'], notification[u'event'], redis=redis)
+    return len(items)
@@ -1,12 +1,21 @@
 import logging
 import datetime
 
+from sqlalchemy import tuple_
+
 from ckan import model as core_model
 from ckan import authz
 from ckan.plugins import toolkit
+from ckan.lib.helpers import date_str_to_datetime
 
-from ckanext.collaborators.model import DatasetMember
-from ckanext.collaborators.mailer import mail_notification_to_collaborator
+from ckanext.collaborators.model import (
+    DatasetMember, upsert_members, delete_members, user_collaborations,
+    refresh_effective, org_dataset_ids, dataset_owner_org, ids_by_id_or_name,
+    sync_resource_visibility)
+from ckanext.collaborators.cache import (
+    invalidate_member, invalidate_members, labels_cache)
+from ckanext.collaborators.jobs import queue_notification
+from ckanext.collaborators import instrumentation
 
 log = logging.getLogger(__name__)
 
@@ -68,6 +77,7 @@ def dataset_collaborator_create(context, data_dict):
         member.modified = datetime.datetime.utcnow()
 
         model.Session.add(member)
+        refresh_effective(user_ids=[user.id], dataset_ids=[dataset.id])
         model.repo.commit()
 
         log.info('User {} added as collaborator in dataset {} ({})'.format(
@@ -94,6 +104,7 @@ def dataset_collaborator_create(context, data_dict):
         member.modified = datetime.datetime.utcnow()
 
         model.Session.add(member)
+        refresh_effective(dataset_ids=[dataset.id])
         model.repo.commit()
 
         log.info('Organization {} added as collaborator in dataset {} ({})'.format(
@@ -102,13 +113,172 @@ def dataset_collaborator_create(context, data_dict):
     else:
         raise toolkit.ValidationError('user_id or org_id required')
 
+    invalidate_member(member.type, member.member_id)
+
+    if member.type == 'user':
+        queue_notification(dataset.id, member.member_id, capacity, 'create')
 
-     # mail_notification_to_collaborator(dataset_id, user_id, capacity,
-                                            # event='create')
-    
     return member.as_dict()
 
 
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _check_access_by_owner_org(auth_name, context, dataset_ids):
+    '''Return a dict telling whether the user passes an auth function on
+    each of the datasets
+
+    The collaborator auth functions only depend on the dataset owner
+    organization, so they are checked once per distinct organization, with
+    one of its datasets, rather than once per dataset.
+    '''
+    model = context.get('model', core_model)
+
+    datasets_by_org = {}
+    for dataset_id, owner_org in model.Session.query(
+            model.Package.id, model.Package.owner_org).filter(
+            model.Package.id.in_(list(dataset_ids))):
+        datasets_by_org.setdefault(owner_org, []).append(dataset_id)
+
+    authorized = {}
+    for grouped_ids in datasets_by_org.values():
+        try:
+            toolkit.check_access(auth_name, context, {'id': grouped_ids[0]})
+            success = True
+        except toolkit.NotAuthorized:
+            success = False
+        for dataset_id in grouped_ids:
+            authorized[dataset_id] = success
+    return authorized
+
+
+def dataset_collaborator_create_many(context, data_dict):
+    '''Make many users or organizations collaborators in datasets at once.
+
+    Existing collaborators get their capacity updated. Datasets, users and
+    organizations are looked up in batches, and all valid collaborators are
+    stored in chunked INSERT ... ON CONFLICT statements and a single commit.
+
+    Invalid collaborators do not prevent the rest from being stored, each
+    gets an error in the results instead.
+
+    Currently you must be an Admin on the dataset owner organization to
+    manage collaborators.
+
+    :param collaborators: the collaborators to add or edit, each a dict with
+        the ``id`` or name of the dataset, the member ``type`` (``user`` or
+        ``org``), the ``member_id`` (id or name of the user or organization)
+        and the ``capacity``
+    :type collaborators: list of dictionaries
+
+    :returns: a list with a result for each of the collaborators provided, in
+        the same order. Each is a dict with ``success`` and either the stored
+        ``collaborator`` or an ``error`` message
+    :rtype: list of dictionaries
+
+    '''
+    model = context.get('model', core_model)
+
+    collaborators = toolkit.get_or_bust(data_dict, 'collaborators')
+    if not isinstance(collaborators, list):
+        raise toolkit.ValidationError(
+            {'collaborators': ['Must be a list of collaborators']})
+
+    required = ('id', 'type', 'member_id', 'capacity')
+    for collaborator in collaborators:
+        if not isinstance(collaborator, dict) or not all(
+                collaborator.get(key) for key in required):
+            raise toolkit.ValidationError(
+                {'collaborators': [
+                    'Each collaborator needs "{}"'.format('", "'.join(required))]})
+
+    datasets = ids_by_id_or_name(
+        model.Package.id, model.Package.name,
+        [c['id'] for c in collaborators])
+    users = ids_by_id_or_name(
+        model.User.id, model.User.name,
+        [c['member_id'] for c in collaborators if c['type'] == 'user'])
+    orgs = ids_by_id_or_name(
+        model.Group.id, model.Group.name,
+        [c['member_id'] for c in collaborators if c['type'] == 'org'])
+
+    authorized = _check_access_by_owner_org(
+        'dataset_collaborator_create', context, set(datasets.values()))
+
+    results = []
+    to_store = {}
+    for index, collaborator in enumerate(collaborators):
+        member_type = collaborator['type']
+        capacity = collaborator['capacity']
+        dataset_id = datasets.get(collaborator['id'])
+
+        error = None
+        if not dataset_id:
+            error = 'Dataset not found'
+        elif not authorized[dataset_id]:
+            error = 'Not authorized to add collaborators to this dataset'
+        elif member_type == 'user':
+            member_id = users.get(collaborator['member_id'])
+            if not member_id:
+                error = 'User not found'
+            elif capacity not in ALLOWED_USER_CAPACITIES:
+                error = 'Capacity must be one of "{}"'.format(
+                    ', '.join(ALLOWED_USER_CAPACITIES))
+        elif member_type == 'org':
+            member_id = orgs.get(collaborator['member_id'])
+            if not member_id:
+                error = 'Organization not found'
+            elif capacity not in ALLOWED_ORG_CAPACITIES:
+                error = 'Capacity must be one of "{}"'.format(
+                    ', '.join(ALLOWED_ORG_CAPACITIES))
+        else:
+            error = 'Type must be one of "{}"'.format(
+                ', '.join(ALLOWED_MEMBER_TYPES))
+
+        if error:
+            results.append({'success': False, 'error': error})
+            continue
+
+        # The last occurrence of a repeated collaborator wins
+        key = (dataset_id, member_type, member_id)
+        to_store[key] = capacity
+        results.append(key)
+
+    chunk_size = toolkit.asint(
+        toolkit.config.get('ckanext.collaborators.bulk_chunk_size', 1000))
+
+    stored = {}
+    for chunk in _chunks(list(to_store.items()), chunk_size):
+        for member in upsert_members([{
+                'dataset_id': dataset_id,
+                'type': member_type,
+                'member_id': member_id,
+                'capacity': capacity,
+                } for (dataset_id, member_type, member_id), capacity in chunk]):
+            stored[(member.dataset_id, member.type, member.member_id)] = \
+                member.as_dict()
+
+    refresh_effective(dataset_ids=set(key[0] for key in to_store))
+    model.repo.commit()
+
+    invalidate_members(
+        (member_type, member_id) for _, member_type, member_id in to_store)
+
+    for (dataset_id, member_type, member_id), capacity in to_store.items():
+        if member_type == 'user':
+            queue_notification(dataset_id, member_id, capacity, 'create')
+
+    log.info('{} collaborators added or updated in {} datasets'.format(
+        len(to_store), len(set(key[0] for key in to_store))))
+
+    return [
+        {'success': True, 'collaborator': stored[result]}
+        if isinstance(result, tuple) else result
+        for result in results]
+
+
 def dataset_collaborator_delete(context, data_dict):
     '''Remove a collaborator from a dataset.
 
@@ -146,17 +316,160 @@ def dataset_collaborator_delete(context, data_dict):
         raise toolkit.ValidationError('Type must be one of "{}"'.format(', '.join(ALLOWED_MEMBER_TYPES)))
     
 
+    capacity = member.capacity
     model.Session.delete(member)
+    refresh_effective(dataset_ids=[dataset.id])
     model.repo.commit()
 
+    invalidate_member(member_type, member_id)
+
     if member_type == 'user':
         log.info('User {} removed as collaborator from dataset {}'.format(member_id, dataset.id))
     elif member_type == 'org':
         log.info('Organization {} removed as collaborator from dataset {}'.format(member_id, dataset.id))
-    
-            
-    #mail_notification_to_collaborator(dataset_id, user_id, member.capacity,
-     #                                   event='delete')
+
+    if member_type == 'user':
+        queue_notification(dataset.id, member_id, capacity, 'delete')
+
+def dataset_collaborator_delete_many(context, data_dict):
+    '''Remove many collaborators at once.
+
+    Collaborators can be given explicitly or selected with filters, eg all
+    the datasets a user or organization collaborates in, or all the
+    collaborators of a dataset. Either way they are removed with a single
+    DELETE statement and one commit.
+
+    You must be allowed to remove collaborators from every affected dataset,
+    otherwise nothing is removed. Currently that means being an Admin on the
+    dataset owner organization.
+
+    :param collaborators: (optional) the collaborators to remove, each a dict
+        with the ``id`` or name of the dataset, the member ``type`` and the
+        ``member_id``
+    :type collaborators: list of dictionaries
+    :param id: (optional) only remove collaborators of this dataset
+    :type id: string
+    :param type: (optional) only remove collaborators of this type. Required
+        with ``member_id``
+    :type type: string
+    :param member_id: (optional) only remove this user or organization
+    :type member_id: string
+    :param capacity: (optional) only remove collaborators with this capacity
+    :type capacity: string
+
+    :returns: the total number of collaborators removed (``count``) and the
+        number removed from each dataset (``datasets``)
+    :rtype: dictionary
+
+    '''
+    model = context.get('model', core_model)
+
+    collaborators = data_dict.get('collaborators')
+    dataset_id = data_dict.get('id')
+    member_type = data_dict.get('type')
+    member_id = data_dict.get('member_id')
+    capacity = data_dict.get('capacity')
+
+    if not (collaborators or dataset_id or member_id):
+        raise toolkit.ValidationError(
+            'Provide collaborators or at least one of "id", "member_id"')
+
+    if member_type and member_type not in ALLOWED_MEMBER_TYPES:
+        raise toolkit.ValidationError(
+            'Type must be one of "{}"'.format(', '.join(ALLOWED_MEMBER_TYPES)))
+    if member_id and not member_type:
+        raise toolkit.ValidationError('"type" is required with "member_id"')
+    if capacity and capacity not in ALLOWED_ORG_CAPACITIES:
+        raise toolkit.ValidationError(
+            'Capacity must be one of "{}"'.format(', '.join(ALLOWED_ORG_CAPACITIES)))
+
+    criteria = []
+
+    if collaborators:
+        if not isinstance(collaborators, list) or not all(
+                isinstance(c, dict) and c.get('id') and c.get('type')
+                and c.get('member_id') for c in collaborators):
+            raise toolkit.ValidationError(
+                {'collaborators': [
+                    'Each collaborator needs "id", "type", "member_id"']})
+
+        datasets = ids_by_id_or_name(
+            model.Package.id, model.Package.name,
+            [c['id'] for c in collaborators])
+        members = {
+            'user': ids_by_id_or_name(
+                model.User.id, model.User.name,
+                [c['member_id'] for c in collaborators if c['type'] == 'user']),
+            'org': ids_by_id_or_name(
+                model.Group.id, model.Group.name,
+                [c['member_id'] for c in collaborators if c['type'] == 'org']),
+        }
+        keys = set()
+        for c in collaborators:
+            key = (datasets.get(c['id']), c['type'],
+                   members.get(c['type'], {}).get(c['member_id']))
+            if all(key):
+                keys.add(key)
+        if not keys:
+            return {'count': 0, 'datasets': {}}
+
+        criteria.append(tuple_(
+            DatasetMember.dataset_id, DatasetMember.type,
+            DatasetMember.member_id).in_(list(keys)))
+
+    if dataset_id:
+        dataset = model.Package.get(dataset_id)
+        if not dataset:
+            raise toolkit.ObjectNotFound('Dataset not found')
+        criteria.append(DatasetMember.dataset_id == dataset.id)
+
+    if member_id:
+        member = (model.User if member_type == 'user' else model.Group).get(
+            member_id)
+        if not member:
+            raise toolkit.ObjectNotFound('{} not found'.format(
+                'User' if member_type == 'user' else 'Organization'))
+        criteria.append(DatasetMember.member_id == member.id)
+
+    if member_type:
+        criteria.append(DatasetMember.type == member_type)
+
+    if capacity:
+        criteria.append(DatasetMember.capacity == capacity)
+
+    dataset_ids = [row[0] for row in model.Session.query(
+        DatasetMember.dataset_id).filter(*criteria).distinct()]
+    if not dataset_ids:
+        return {'count': 0, 'datasets': {}}
+
+    authorized = _check_access_by_owner_org(
+        'dataset_collaborator_delete', context, dataset_ids)
+    if not all(authorized.values()):
+        raise toolkit.NotAuthorized(
+            'Not authorized to remove collaborators from all these datasets')
+
+    # Never touch datasets that were not authorized above
+    deleted = delete_members(
+        DatasetMember.dataset_id.in_(dataset_ids), *criteria)
+    refresh_effective(dataset_ids=set(row[0] for row in deleted))
+    model.repo.commit()
+
+    invalidate_members(
+        (deleted_type, deleted_id) for _, deleted_type, deleted_id, _ in deleted)
+
+    counts = {}
+    for deleted_dataset_id, deleted_type, deleted_id, deleted_capacity \
+            in deleted:
+        counts[deleted_dataset_id] = counts.get(deleted_dataset_id, 0) + 1
+        if deleted_type == 'user':
+            queue_notification(
+                deleted_dataset_id, deleted_id, deleted_capacity, 'delete')
+
+    log.info('{} collaborators removed from {} datasets'.format(
+        len(deleted), len(counts)))
+
+    return {'count': len(deleted), 'datasets': counts}
+
 
 def dataset_collaborator_list(context, data_dict):
     '''Return the list of all collaborators for a given dataset.
@@ -207,9 +520,131 @@ def dataset_collaborator_list(context, data_dict):
     return [member.as_dict() for member in members]
 
 
+def dataset_collaborator_show(context, data_dict):
+    '''Return a single collaborator of a dataset.
+
+    Currently you must be an Admin on the dataset owner organization to
+    manage collaborators.
+
+    :param id: the id or name of the dataset
+    :type id: string
+    :param type: the type of the collaborator, one of "{}"
+    :type type: string
+    :param member_id: the id of the user or organization
+    :type member_id: string
+
+    :returns: the collaborator, including the dataset and member id, the
+        capacity and the last modified date
+    :rtype: dictionary
+
+    '''.format('", "'.join(ALLOWED_MEMBER_TYPES))
+    model = context.get('model', core_model)
+
+    dataset_id, member_type, member_id = toolkit.get_or_bust(
+        data_dict, ['id', 'type', 'member_id'])
+
+    if member_type not in ALLOWED_MEMBER_TYPES:
+        raise toolkit.ValidationError('Type must be one of "{}"'.format(', '.join(ALLOWED_MEMBER_TYPES)))
+
+    dataset = dataset_owner_org(dataset_id)
+    if not dataset:
+        raise toolkit.ObjectNotFound('Dataset not found')
+
+    toolkit.check_access('dataset_collaborator_show', context, data_dict)
+
+    member = model.Session.query(DatasetMember).\
+        filter(DatasetMember.dataset_id == dataset[0]).\
+        filter(DatasetMember.type == member_type).\
+        filter(DatasetMember.member_id == member_id).one_or_none()
+
+    if not member:
+        if member_type == 'user':
+            raise toolkit.ObjectNotFound('User {} is not a collaborator on this dataset'.format(member_id))
+        raise toolkit.ObjectNotFound('Organization {} is not a collaborator on this dataset'.format(member_id))
+
+    return member.as_dict()
+
+
+def dataset_collaborator_list_many(context, data_dict):
+    '''Return the collaborators of several datasets at once.
+
+    All collaborators are fetched with a single query and permissions are
+    checked once per owner organization, rather than once per dataset.
+
+    Currently you must be an Admin on the owner organization of every
+    dataset to manage collaborators.
+
+    :param ids: the ids or names of the datasets. At most
+        ``ckanext.collaborators.list_many_limit`` (default 100) are allowed
+    :type ids: list of strings
+    :param type: (optional) If provided, only collaborators of this type are
+        returned
+    :type type: string
+    :param capacity: (optional) If provided, only collaborators with this
+        capacity are returned
+    :type capacity: string
+
+    :returns: a dict keyed by dataset id, with the list of collaborators of
+        each dataset as returned by ``dataset_collaborator_list``
+    :rtype: dictionary
+
+    '''
+    model = context.get('model', core_model)
+
+    ids = toolkit.get_or_bust(data_dict, 'ids')
+    if isinstance(ids, basestring):
+        ids = [ids]
+
+    limit = toolkit.asint(
+        toolkit.config.get('ckanext.collaborators.list_many_limit', 100))
+    if len(ids) > limit:
+        raise toolkit.ValidationError(
+            {'ids': ['At most {} datasets are allowed'.format(limit)]})
+
+    datasets = ids_by_id_or_name(
+        model.Package.id, model.Package.name, ids)
+    missing = [dataset_id for dataset_id in ids if dataset_id not in datasets]
+    if missing:
+        raise toolkit.ObjectNotFound(
+            'Dataset not found: {}'.format(', '.join(missing)))
+
+    dataset_ids = sorted(set(datasets.values()))
+
+    toolkit.check_access(
+        'dataset_collaborator_list_many', context, {'ids': dataset_ids})
+
+    member_type = data_dict.get('type')
+    if member_type and member_type not in ALLOWED_MEMBER_TYPES:
+        raise toolkit.ValidationError('Type must be one of "{}"'.format(', '.join(ALLOWED_MEMBER_TYPES)))
+
+    capacity = data_dict.get('capacity')
+    if capacity and capacity not in ALLOWED_ORG_CAPACITIES:
+        raise toolkit.ValidationError('Capacity must be one of "{}"'.format(', '.join(ALLOWED_ORG_CAPACITIES)))
+
+    q = model.Session.query(DatasetMember).\
+        filter(DatasetMember.dataset_id.in_(dataset_ids))
+
+    if member_type:
+        q = q.filter(DatasetMember.type == member_type)
+
+    if capacity:
+        q = q.filter(DatasetMember.capacity == capacity)
+
+    out = dict((dataset_id, []) for dataset_id in dataset_ids)
+    for member in q:
+        out[member.dataset_id].append(member.as_dict())
+
+    return out
+
+
 def dataset_collaborator_list_for_user(context, data_dict):
     '''Return a list of all dataset the user is a collaborator in
 
+    Results are sorted by modification date. Large lists can be paginated
+    with ``limit`` and ``offset``, or more efficiently by passing the
+    ``modified`` and ``id`` of the last result received as ``after_modified``
+    and ``after_id``.
+
     :param id: the id or name of the user
     :type id: string
     :param capacity: (optional) If provided, only datasets where the user has this
@@ -218,9 +653,19 @@ def dataset_collaborator_list_for_user(context, data_dict):
     :param permission: (optional) If provided, only datasets where the user has a
         capacity with the requested permission are returned
     :type capacity: string
-
-    :returns: a list of datasets, each a dict including the dataset id, the
-        capacity and the last modified date
+    :param limit: (optional) the maximum number of results to return
+    :type limit: int
+    :param offset: (optional) the number of results to skip
+    :type offset: int
+    :param after_modified: (optional) only return results after the one with
+        this modified date and ``after_id``
+    :type after_modified: string
+    :param after_id: (optional) only return results after the one with this id
+        and ``after_modified``
+    :type after_id: string
+
+    :returns: a list of datasets, each a dict including the collaboration id,
+        the dataset id, the capacity and the last modified date
     :rtype: list of dictionaries
 
     '''
@@ -242,8 +687,24 @@ def dataset_collaborator_list_for_user(context, data_dict):
     capacity = data_dict.get('capacity')
     if capacity and capacity not in ALLOWED_USER_CAPACITIES:
         raise toolkit.ValidationError('Capacity must be one of "{}"'.format(', '.join(ALLOWED_USER_CAPACITIES)))
-    
-    
+
+    try:
+        limit = toolkit.asint(data_dict.get('limit', 0))
+        offset = toolkit.asint(data_dict.get('offset', 0))
+    except ValueError:
+        raise toolkit.ValidationError('"limit" and "offset" must be integers')
+
+    after_modified = data_dict.get('after_modified')
+    after_id = data_dict.get('after_id')
+    if bool(after_modified) != bool(after_id):
+        raise toolkit.ValidationError(
+            '"after_modified" and "after_id" must be provided together')
+    if after_modified:
+        try:
+            after_modified = date_str_to_datetime(after_modified)
+        except (TypeError, ValueError):
+            raise toolkit.ValidationError('"after_modified" must be a date')
+
     roles = authz.get_roles_with_permission(permission)
     
     if capacity and capacity not in roles:
@@ -252,64 +713,145 @@ def dataset_collaborator_list_for_user(context, data_dict):
     if capacity :
         roles = [capacity]
 
-    out = []
+    q = user_collaborations(
+        user.id, roles, member_type=member_type,
+        after=(after_modified, after_id) if after_modified else None).\
+        order_by(DatasetMember.modified, DatasetMember.id)
 
+    if offset:
+        q = q.offset(offset)
 
-    if not member_type or member_type == 'user' :   
-        q = model.Session.query(DatasetMember).\
-            filter((DatasetMember.type == 'user') & (DatasetMember.member_id == user.id))
+    if limit:
+        q = q.limit(limit)
 
-        if capacity:
-            q = q.filter(DatasetMember.capacity == capacity )
-        
-        if permission:
-            q = q.filter(DatasetMember.capacity.in_( roles) )
-        
-        members = q.all()
-        
-        for member in members:
-            out.append({
-                'dataset_id': member.dataset_id,
-                'type': 'user',
-                'capacity': member.capacity,
-                'modified': member.modified.isoformat(),
-            })
+    return [{
+        'id': member.id,
+        'dataset_id': member.dataset_id,
+        'type': member.type,
+        'capacity': member_capacity,
+        'modified': member.modified.isoformat(),
+    } for member, member_capacity in q]
+
+def _refresh_org_user(context, data_dict):
+    '''Update the effective permissions of a user whose membership of an
+    organization changed'''
+    model = context.get('model', core_model)
 
+    if data_dict.get('object_type') != 'user':
+        return
 
-    if not member_type or member_type == 'org':
+    group = model.Group.get(data_dict.get('id'))
+    user = model.User.get(data_dict.get('object'))
+    if not group or not group.is_organization or not user:
+        return
 
-        user_orgs = toolkit.get_action('organization_list_for_user')(context, data_dict={'id': user.id} )
+    refresh_effective(
+        user_ids=[user.id], dataset_ids=org_dataset_ids(group.id))
+    model.repo.commit()
 
-        user_org_ids = [ org['id'] for org in user_orgs]
+    invalidate_member('user', user.id)
 
-        q = model.Session.query(DatasetMember).\
-            filter(DatasetMember.type == 'org').\
-            filter(DatasetMember.member_id.in_( user_org_ids))
-
-        members = q.all()
-
-        for member in members:
-
-            if  member.capacity == 'inherit':
-                org = next( user_org for user_org in user_orgs if user_org['id'] == member.member_id )
-                capacity = 'editor' if org.capacity == 'admin' else org.capacity
-                if capacity in roles:
-                    out.append({
-                        'dataset_id': member.dataset_id,
-                        'type':'org',
-                        'capacity': capacity,
-                        'modified': member.modified.isoformat(),
-                    })
-
-            elif member.capacity in roles:
-                out.append({
-                    'dataset_id': member.dataset_id,
-                    'type':'org',
-                    'capacity': member.capacity,
-                    'modified': member.modified.isoformat(),
-                })
 
-    return out
+# Core overrides
+@toolkit.chained_action
+def member_create(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    _refresh_org_user(context, data_dict)
+    return result
+
+
+@toolkit.chained_action
+def member_delete(next_action, context, data_dict):
+    result = next_action(context, data_dict)
+    _refresh_org_user(context, data_dict)
+    return result
+
+
+@toolkit.chained_action
+def dataset_purge(next_action, context, data_dict):
+    model = context.get('model', core_model)
+
+    dataset = model.Package.get(toolkit.get_or_bust(data_dict, 'id'))
+    dataset_id = dataset.id if dataset else None
+
+    result = next_action(context, data_dict)
+
+    if dataset_id:
+        deleted = delete_members(DatasetMember.dataset_id == dataset_id)
+        sync_resource_visibility([dataset_id])
+        refresh_effective(dataset_ids=[dataset_id])
+        model.repo.commit()
+
+        invalidate_members(
+            (member_type, member_id) for _, member_type, member_id, _ in deleted)
+    return result
+
+
+@toolkit.chained_action
+def user_delete(next_action, context, data_dict):
+    model = context.get('model', core_model)
+
+    user = model.User.get(toolkit.get_or_bust(data_dict, 'id'))
+    user_id = user.id if user else None
+
+    result = next_action(context, data_dict)
+
+    if user_id:
+        delete_members(
+            DatasetMember.type == 'user', DatasetMember.member_id == user_id)
+        # Organization memberships are gone too
+        refresh_effective(user_ids=[user_id])
+        model.repo.commit()
+
+        invalidate_member('user', user_id)
+    return result
+
+
+def collaborators_cache_stats(context, data_dict):
+    '''Return the hit and miss counters of the labels cache
+
+    Only sysadmins can call this action. Counters are those of the process
+    handling the request.
+
+    :returns: the backend, limits and counters of the cache
+    :rtype: dictionary
+
+    '''
+    toolkit.check_access('collaborators_cache_stats', context, data_dict)
+
+    return {
+        'labels': labels_cache().stats(),
+    }
+
+
+def collaborators_stats(context, data_dict):
+    '''Return the timings and SQL statement counts of the collaborators
+    actions and auth functions
+
+    Only sysadmins can call this action. Calls are recorded only when
+    ``ckanext.collaborators.instrumentation`` is enabled, and the figures
+    are those of the process handling the request.
+
+    :param reset: (optional) clear the recorded figures after returning
+        them (default: False)
+    :type reset: bool
+
+    :returns: whether instrumentation is enabled and, for each function
+        called, the number of calls, total, mean and max milliseconds,
+        SQL statements and rows
+    :rtype: dictionary
+
+    '''
+    toolkit.check_access('collaborators_stats', context, data_dict)
+
+    stats = instrumentation.get_stats()
+    if toolkit.asbool(data_dict.get('reset', False)):
+        instrumentation.reset_stats()
+
+    return {
+        'enabled': instrumentation.enabled(),
+        'calls': stats,
+    }
 
 def dataset_collaborator_list_for_organization(context, data_dict):
     '''Return a list of all dataset the user is a collaborator in
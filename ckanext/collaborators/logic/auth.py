@@ -5,21 +5,25 @@ import logging
 import ckan.model as model
 
 import ckan.logic as logic
-from ckan.logic.auth import (get_package_object, get_resource_object)
-from ckan.authz import has_user_permission_for_group_or_org
+from ckan.logic.auth import get_package_object
+from ckan.authz import (
+    has_user_permission_for_group_or_org, get_roles_with_permission)
 # from ckan.logic.auth.update import package_update as core_package_update
 from ckan.logic.auth.get import resource_show as core_resource_show
 # from ckan.logic.auth.get import package_show as core_package_show
 
+from ckanext.collaborators.model import (
+    resource_visibilities, VISIBILITY_PACKAGE, VISIBILITY_EDITOR,
+    VISIBILITY_OWNER, VISIBILITY_COLLABORATOR)
+from ckanext.collaborators.cache import (
+    user_has_capacity, get_dataset_owner_org, request_cache)
+
 log = logging.getLogger()
 
 def _auth_collaborator(context, data_dict, message):
     user = context['user']
 
-    dataset = toolkit.get_action('package_show')(
-        {'ignore_auth': True}, {'id': data_dict['id']})
-
-    owner_org = dataset.get('owner_org')
+    owner_org = get_dataset_owner_org(data_dict['id'])
     if not owner_org:
         return {'success': False}
 
@@ -62,6 +66,41 @@ def dataset_collaborator_list(context, data_dict):
         'User %s not authorized to list members from this dataset')
 
 
+def dataset_collaborator_show(context, data_dict):
+    '''Checks if a user is allowed to see a collaborator of a dataset
+
+    Same rules as dataset_collaborator_list.
+    '''
+    return _auth_collaborator(context, data_dict,
+        'User %s not authorized to read members from this dataset')
+
+
+def dataset_collaborator_list_many(context, data_dict):
+    '''Checks if a user is allowed to list collaborators of many datasets
+
+    Same rules as dataset_collaborator_list, but organization permissions
+    are checked once per distinct owner organization.
+    '''
+    user = context['user']
+    dataset_ids = data_dict.get('ids') or []
+
+    owner_orgs = set(owner_org for (owner_org,) in model.Session.query(
+        model.Package.owner_org).filter(model.Package.id.in_(dataset_ids)))
+
+    if not owner_orgs or None in owner_orgs:
+        return {'success': False}
+
+    for owner_org in owner_orgs:
+        if not has_user_permission_for_group_or_org(
+                owner_org, user, 'update_dataset'):
+            return {
+                'success': False,
+                'msg': toolkit._(
+                    'User %s not authorized to list members from these datasets') % user}
+
+    return {'success': True}
+
+
 def dataset_collaborator_list_for_user(context, data_dict):
     '''Checks if a user is allowed to list all datasets a user is a collaborator in
 
@@ -73,63 +112,96 @@ def dataset_collaborator_list_for_user(context, data_dict):
     return {'success': False}
 
 
+def collaborators_cache_stats(context, data_dict):
+    '''Only sysadmins can see the cache statistics'''
+    return {'success': False}
+
+
+def collaborators_stats(context, data_dict):
+    '''Only sysadmins can see the instrumentation statistics'''
+    return {'success': False}
+
+
 # Core overrides
 @toolkit.chained_auth_function
 def package_update(next_auth, context, data_dict):
 
-    user = context['auth_user_obj']
-    dataset = get_package_object(context, data_dict)
-
-    datasets = toolkit.get_action('dataset_collaborator_list_for_user')(
-        {'ignore_auth': True}, {'id': user.id, 'capacity': 'editor'})
-
-    if  dataset.id in [d['dataset_id'] for d in datasets]:
-        return {'success': True}
+    user = context.get('auth_user_obj')
+    if user:
+        dataset = get_package_object(context, data_dict)
+        if user_has_capacity(user.id, dataset.id, ['editor']):
+            return {'success': True}
 
     return next_auth(context, data_dict)
         
 
-#@toolkit.chained_auth_function
+# The (permission, require_owner) needed to see resources of each
+# visibility. Other resources are visible to anyone seeing the dataset
+VISIBILITY_RULES = {
+    VISIBILITY_EDITOR: ('update_dataset', False),
+    VISIBILITY_OWNER: ('read', True),
+    # collaborator member
+    VISIBILITY_COLLABORATOR: ('read', False),
+}
+
+
+def visible_resource_ids(context, package_obj):
+    '''Return the ids of the dataset resources the user is allowed to see
+
+    Organization permissions and collaborator memberships are checked once
+    per required permission, rather than once per resource, and the result
+    is kept for the rest of the request so that the resource_show checks
+    for every resource of the dataset are answered from memory.
+    '''
+    user_name = context.get('user')
+    user_obj = context.get('auth_user_obj')
+
+    cached = request_cache('visible_resources')
+    key = (user_name, package_obj.id)
+    if cached is not None and key in cached:
+        return cached[key]
+
+    granted = {}
+
+    def allowed(permission, require_owner):
+        if (permission, require_owner) not in granted:
+            success = has_user_permission_for_group_or_org(
+                package_obj.owner_org, user_name, permission)
+            if not success and not require_owner and user_obj:
+                success = user_has_capacity(
+                    user_obj.id, package_obj.id,
+                    get_roles_with_permission(permission))
+            granted[(permission, require_owner)] = success
+        return granted[(permission, require_owner)]
+
+    visible = set()
+    for resource_id, visibility in resource_visibilities(package_obj.id):
+        if visibility == VISIBILITY_PACKAGE or allowed(
+                *VISIBILITY_RULES[visibility]):
+            visible.add(resource_id)
+
+    if cached is not None:
+        cached[key] = visible
+    return visible
+
+
 @toolkit.auth_allow_anonymous_access
-def resource_show( context, data_dict):
+def resource_show(context, data_dict):
 
     base_auth = core_resource_show(context, data_dict)
     if not base_auth['success']:
         return base_auth
-    
-    r = context.pop('resource',False)
-
-    resource_obj = get_resource_object(context, data_dict)
-    visibility = resource_obj.extras.get('visibility','package')
-    
-    if visibility.startswith('editor'):
-        required_permission = 'dataset_update'
-        require_owner = False
-    elif visibility.startswith('owner'):
-        required_permission = 'read'
-        require_owner = True
-    elif visibility.startswith('collaborator'):
-        # collaborator member
-        required_permission = 'read'
-        require_owner = False
-    else:
-        return {'success': True}
+
+    # resource_view_show passes the view id, with the resource in the context
+    resource_obj = model.Resource.get(data_dict.get('id')) or context.get('resource')
+    if not resource_obj:
+        raise toolkit.ObjectNotFound('Resource not found')
 
     package_obj = get_package_object(context, {'id': resource_obj.package_id})
-    user_name = context['user']
 
-    if has_user_permission_for_group_or_org(package_obj.owner_org, user_name, required_permission):
+    if resource_obj.id in visible_resource_ids(context, package_obj):
         return {'success': True}
 
-    if require_owner:
-        return {'success': False}
-
-    collaborator_packages = toolkit.get_action('dataset_collaborator_list_for_user')(
-        context, {'id': user_name, 'permission': required_permission})
-
-    if package_obj.id in [p['dataset_id'] for p in collaborator_packages]:
-        return {'success': True}
-    
     return {'success': False}
 
 # @toolkit.auth_allow_anonymous_access
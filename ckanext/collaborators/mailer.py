@@ -1,18 +1,42 @@
+import time
+import socket
+import smtplib
 import logging
+import threading
+from collections import namedtuple
+from email.mime.text import MIMEText
+from email.header import Header
+from email import utils
+
+import ckan
 from ckan import model as core_model
 from ckan.plugins import toolkit
-from ckan.lib.mailer import mail_user, MailerException
-from ckan.lib.base import render_jinja2
+from ckan.lib.mailer import MailerException
 log = logging.getLogger(__name__)
 
 
+Message = namedtuple('Message', ['name', 'email', 'subject', 'body'])
+
+
+_templates = {}
+
+
+def _render(template_name, extra_vars):
+    '''Render an email template, compiling it only the first time'''
+    template = _templates.get(template_name)
+    if template is None:
+        env = toolkit.config['pylons.app_globals'].jinja_env
+        template = _templates[template_name] = env.get_template(template_name)
+    return template.render(**extra_vars)
+
+
 def _compose_email_subj(dataset):
-    return '{0} - Notification about collaborator role for {1}'.format(
+    return u'{0} - Notification about collaborator role for {1}'.format(
         toolkit.config.get('ckan.site_title'), dataset.title)
 
 def _compose_email_body(user, dataset, role, event):
     dataset_link = toolkit.url_for('dataset_read', id=dataset.id, qualified=True)
-    return render_jinja2('emails/{0}_collaborator.html'.format(event), {
+    return _render('emails/{0}_collaborator.html'.format(event), {
         'user_name': user.fullname or user.name,
         'role': role,
         'site_title': toolkit.config.get('ckan.site_title'),
@@ -21,15 +45,302 @@ def _compose_email_body(user, dataset, role, event):
         'dataset_link': dataset_link
 })
 
-def mail_notification_to_collaborator(dataset_id, user_id, capacity, event):
+def send_notification_to_collaborator(dataset_id, user_id, capacity, event):
+    '''Email a collaborator about a change in their role
+
+    Nothing is sent if the user or dataset no longer exist, or if the user
+    has no email address.
+
+    :raises: MailerException if the email could not be sent
+    '''
     user = core_model.User.get(user_id)
     dataset = core_model.Package.get(dataset_id)
 
+    if not user or not dataset:
+        log.warning(u'Not notifying user {}, user or dataset {} not found'.format(
+            user_id, dataset_id))
+        return
+    if not user.email:
+        log.debug(u'Not notifying user {}, no email address'.format(user_id))
+        return
+
+    message = Message(
+        user.fullname or user.name, user.email,
+        _compose_email_subj(dataset),
+        _compose_email_body(user, dataset, capacity, event))
+
+    errors = send_messages([message])
+    if errors:
+        raise errors[0]
+
+
+def mail_notification_to_collaborator(dataset_id, user_id, capacity, event):
     try:
-        subj = _compose_email_subj(dataset)
-        body = _compose_email_body(user, dataset, capacity, event)
-        mail_user(user, subj, body, headers={
-            'Content-Type': 'text/html; charset=UTF-8'
-        })
+        send_notification_to_collaborator(dataset_id, user_id, capacity, event)
     except MailerException as exception:
         log.exception(exception)
+
+
+def _compose_digest_body(user, changes):
+    return _render('emails/digest_collaborator.html', {
+        'user_name': user.fullname or user.name,
+        'changes': changes,
+        'site_title': toolkit.config.get('ckan.site_title'),
+        'site_url': toolkit.config.get('ckan.site_url'),
+})
+
+
+def compose_digest(user_id, notifications):
+    '''Return a single Message summarizing many notifications to a user
+
+    :param notifications: dicts with the dataset_id, capacity and event of
+        each notification, in the order they happened
+
+    Returns None if there is nothing to send, eg because the user has no
+    email address or all the datasets have been deleted since.
+    '''
+    user = core_model.User.get(user_id)
+    if not user or not user.email:
+        log.debug(u'Not notifying user {}, not found or no email'.format(
+            user_id))
+        return None
+
+    datasets = dict((dataset.id, dataset) for dataset in core_model.Session.
+                    query(core_model.Package).filter(core_model.Package.id.in_(
+                        set(n['dataset_id'] for n in notifications))))
+
+    changes = []
+    for notification in notifications:
+        dataset = datasets.get(notification['dataset_id'])
+        if not dataset:
+            continue
+        changes.append({
+            'event': notification['event'],
+            'role': notification['capacity'],
+            'dataset_title': dataset.title,
+            'dataset_link': toolkit.url_for(
+                'dataset_read', id=dataset.id, qualified=True),
+        })
+    if not changes:
+        return None
+
+    subject = u'{0} - Changes to your collaborator roles'.format(
+        toolkit.config.get('ckan.site_title'))
+    return Message(user.fullname or user.name, user.email, subject,
+                   _compose_digest_body(user, changes))
+
+
+def _smtp_connect():
+    config = toolkit.config
+    if config.get('smtp.test_server'):
+        # Same as ckan.lib.mailer, used by the tests mock server
+        smtp_server = config['smtp.test_server']
+        starttls = False
+        smtp_user = smtp_password = None
+    else:
+        smtp_server = config.get('smtp.server', 'localhost')
+        starttls = toolkit.asbool(config.get('smtp.starttls'))
+        smtp_user = config.get('smtp.user')
+        smtp_password = config.get('smtp.password')
+
+    connection = smtplib.SMTP(smtp_server)
+    connection.ehlo_or_helo_if_needed()
+    if starttls:
+        if not connection.has_extn('STARTTLS'):
+            raise MailerException(
+                u'SMTP server does not support STARTTLS')
+        connection.starttls()
+        connection.ehlo()
+    if smtp_user:
+        connection.login(smtp_user, smtp_password)
+    return connection
+
+
+def _close(connection):
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, socket.error):
+        connection.close()
+
+
+class SMTPConnectionPool(object):
+    '''A thread-safe pool of open SMTP connections
+
+    Up to `size` idle connections are kept open between sends. Connections
+    idle for longer than `keepalive` seconds are assumed to have been closed
+    by the server, and are replaced by new ones.
+    '''
+
+    def __init__(self, size, keepalive, connect=_smtp_connect):
+        self.size = size
+        self.keepalive = keepalive
+        self._connect = connect
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        '''Return an open connection, reusing an idle one if possible'''
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            if time.time() - last_used <= self.keepalive:
+                return connection
+            _close(connection)
+        return self._connect()
+
+    def put(self, connection):
+        '''Return a connection to the pool once done with it'''
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((connection, time.time()))
+                return
+        _close(connection)
+
+    def discard(self, connection):
+        '''Close a connection that can not be used any more'''
+        try:
+            connection.close()
+        except socket.error:
+            pass
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, last_used in idle:
+            _close(connection)
+
+
+_pool = None
+
+
+def smtp_pool():
+    '''Return the SMTP connection pool of this process'''
+    global _pool
+    if _pool is None:
+        config = toolkit.config
+        _pool = SMTPConnectionPool(
+            size=toolkit.asint(
+                config.get('ckanext.collaborators.mail.pool_size', 2)),
+            keepalive=toolkit.asint(
+                config.get('ckanext.collaborators.mail.keepalive', 60)))
+    return _pool
+
+
+def _mime_message(message):
+    config = toolkit.config
+    msg = MIMEText(message.body.encode('utf-8'), 'html', 'utf-8')
+    msg['Subject'] = Header(message.subject.encode('utf-8'), 'utf-8')
+    msg['From'] = u'{} <{}>'.format(
+        config.get('ckan.site_title'), config.get('smtp.mail_from'))
+    msg['To'] = Header(
+        u'{} <{}>'.format(message.name, message.email), 'utf-8')
+    msg['Date'] = utils.formatdate(time.time())
+    msg['X-Mailer'] = 'CKAN {}'.format(ckan.__version__)
+    reply_to = config.get('smtp.reply_to')
+    if reply_to:
+        msg['Reply-to'] = reply_to
+    return msg.as_string()
+
+
+def _pipelined_sendmail(connection, from_addr, to_addrs, msg):
+    '''Like SMTP.sendmail, but sending MAIL, RCPT and DATA at once
+
+    Only used with servers supporting the PIPELINING extension (RFC 2920),
+    it saves two round trips per message.
+    '''
+    commands = ['MAIL FROM:{}'.format(smtplib.quoteaddr(from_addr))]
+    commands.extend(
+        'RCPT TO:{}'.format(smtplib.quoteaddr(addr)) for addr in to_addrs)
+    commands.append('DATA')
+    connection.send(''.join(command + smtplib.CRLF for command in commands))
+
+    code, resp = connection.getreply()
+    if code != 250:
+        # The rest of the commands failed too, read their replies
+        for _ in commands[1:]:
+            connection.getreply()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    refused = {}
+    for addr in to_addrs:
+        code, resp = connection.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+
+    code, resp = connection.getreply()
+    if code != 354:
+        if len(refused) == len(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        raise smtplib.SMTPDataError(code, resp)
+    if len(refused) == len(to_addrs):
+        # Some servers accept DATA with no valid recipients, end it empty
+        connection.send('.' + smtplib.CRLF)
+        connection.getreply()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    data = smtplib.quotedata(msg)
+    if data[-2:] != smtplib.CRLF:
+        data += smtplib.CRLF
+    connection.send(data + '.' + smtplib.CRLF)
+    code, resp = connection.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+def _sendmail(connection, from_addr, to_addrs, msg):
+    if connection.has_extn('pipelining'):
+        return _pipelined_sendmail(connection, from_addr, to_addrs, msg)
+    return connection.sendmail(from_addr, to_addrs, msg)
+
+
+def send_messages(messages):
+    '''Send many Messages reusing the pooled SMTP connections
+
+    The whole batch is sent over one connection, pipelining the commands of
+    each message when the server allows it. If the connection turns out to
+    be closed, the message is sent again over a new one.
+
+    Returns a dict mapping the index of each message that could not be sent
+    to its error.
+    '''
+    pool = smtp_pool()
+    mail_from = toolkit.config.get('smtp.mail_from')
+    errors = {}
+    connection = None
+    try:
+        for index, message in enumerate(messages):
+            msg = _mime_message(message)
+            for attempt in range(2):
+                try:
+                    if connection is None:
+                        connection = pool.get()
+                    _sendmail(connection, mail_from, [message.email], msg)
+                    break
+                except (smtplib.SMTPRecipientsRefused,
+                        smtplib.SMTPSenderRefused,
+                        smtplib.SMTPDataError) as e:
+                    # The message was refused, but the connection is fine
+                    errors[index] = MailerException(u'{}'.format(e))
+                    try:
+                        connection.rset()
+                    except (smtplib.SMTPException, socket.error):
+                        pool.discard(connection)
+                        connection = None
+                    break
+                except (smtplib.SMTPException, socket.error,
+                        MailerException) as e:
+                    if connection is not None:
+                        pool.discard(connection)
+                        connection = None
+                    if attempt:
+                        errors[index] = MailerException(u'{}'.format(e))
+                    else:
+                        log.debug(u'SMTP connection lost, reconnecting: '
+                                  u'{}'.format(e))
+    finally:
+        if connection is not None:
+            pool.put(connection)
+    return errors
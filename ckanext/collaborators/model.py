@@ -1,14 +1,24 @@
 # encoding: utf-8
 
+import csv
 import datetime
+import io
 import uuid
 import logging
 from collections import OrderedDict
 
-from sqlalchemy import orm, Column, Unicode, DateTime
+from sqlalchemy import (
+    orm, inspect, func, case, select, union, exists, and_, or_, tuple_,
+    literal_column, text, Table, MetaData, Column, Unicode, DateTime,
+    SmallInteger, Index)
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects import postgresql
 
-from ckan.model.meta import metadata
+from ckan.model.meta import metadata, Session
+from ckan.model.group import Group, Member
+from ckan.model.user import User
+from ckan.model.package import Package
+from ckan.model.resource import Resource
 
 log = logging.getLogger(__name__)
 
@@ -22,6 +32,14 @@ Base = declarative_base(metadata=metadata)
 
 class DatasetMember(Base):
     __tablename__ = u'dataset_member'
+    __table_args__ = (
+        Index(u'idx_dataset_member_dataset_type_member',
+              u'dataset_id', u'type', u'member_id', unique=True),
+        Index(u'idx_dataset_member_type_member_capacity',
+              u'type', u'member_id', u'capacity'),
+        Index(u'idx_dataset_member_dataset_capacity',
+              u'dataset_id', u'capacity'),
+    )
 
     id = Column(Unicode, primary_key=True, default=make_uuid)
     type = Column(Unicode, nullable=False)          #user vs org
@@ -43,13 +61,520 @@ class DatasetMember(Base):
         return _dict
 
 
+class DatasetMemberEffective(Base):
+    '''The capacities each user effectively holds on each dataset
+
+    Derived from dataset_member and the core organization memberships, with
+    `inherit` already resolved, so permission checks are a single primary key
+    lookup. Kept up to date with refresh_effective().
+    '''
+    __tablename__ = u'dataset_member_effective'
+    __table_args__ = (
+        Index(u'idx_dataset_member_effective_dataset', u'dataset_id'),
+    )
+
+    user_id = Column(Unicode, primary_key=True)
+    dataset_id = Column(Unicode, primary_key=True)
+    capacity = Column(Unicode, primary_key=True)
+
+
+VISIBILITY_PACKAGE = 0
+VISIBILITY_EDITOR = 1
+VISIBILITY_OWNER = 2
+VISIBILITY_COLLABORATOR = 3
+
+
+def visibility_code(visibility):
+    '''Return the code stored for the `visibility` extra of a resource'''
+    visibility = visibility or u'package'
+    if visibility.startswith(u'editor'):
+        return VISIBILITY_EDITOR
+    elif visibility.startswith(u'owner'):
+        return VISIBILITY_OWNER
+    elif visibility.startswith(u'collaborator'):
+        return VISIBILITY_COLLABORATOR
+    return VISIBILITY_PACKAGE
+
+
+class ResourceVisibility(Base):
+    '''The visibility of each resource, as one of the VISIBILITY_* codes
+
+    Mirrors the `visibility` resource extra so that permission checks do not
+    need to load and deserialize the extras. Resources without a row are
+    visible to anyone who can see the dataset.
+    '''
+    __tablename__ = u'resource_visibility'
+    __table_args__ = (
+        Index(u'idx_resource_visibility_package', u'package_id'),
+    )
+
+    resource_id = Column(Unicode, primary_key=True)
+    package_id = Column(Unicode, nullable=False)
+    visibility = Column(SmallInteger, nullable=False)
+
+
+TABLES = [
+    DatasetMember.__table__,
+    DatasetMemberEffective.__table__,
+    ResourceVisibility.__table__,
+]
+
+
+def _org_member_join(user_id):
+    return and_(
+        Member.group_id == DatasetMember.member_id,
+        Member.table_name == u'user',
+        Member.table_id == user_id,
+        Member.state == u'active')
+
+
+def is_collaborator(user_id, dataset_id, capacities):
+    '''Return True if the user holds one of the capacities on the dataset
+
+    Both direct user memberships and memberships inherited from the
+    organizations the user belongs to are considered, with a single primary
+    key lookup on dataset_member_effective.
+    '''
+    return Session.query(Session.query(DatasetMemberEffective).filter(
+        DatasetMemberEffective.user_id == user_id,
+        DatasetMemberEffective.dataset_id == dataset_id,
+        DatasetMemberEffective.capacity.in_(capacities)).exists()).scalar()
+
+
+def _effective_capacity():
+    '''SQL expression for the capacity an organization membership grants,
+    resolving `inherit` to the user capacity in the organization'''
+    return case([
+        (DatasetMember.capacity != u'inherit', DatasetMember.capacity),
+        (Member.capacity == u'admin', u'editor'),
+    ], else_=Member.capacity)
+
+
+def user_memberships(user_id):
+    '''Return a (dataset_id, capacity) tuple for each membership of the user
+
+    Memberships inherited from the user organizations are included, with the
+    `inherit` capacity already resolved. Rows are streamed from a server side
+    cursor, so memory use does not grow with the number of memberships.
+    '''
+    return Session.query(
+        DatasetMemberEffective.dataset_id,
+        DatasetMemberEffective.capacity).filter(
+        DatasetMemberEffective.user_id == user_id).yield_per(1000)
+
+
+def _effective_source(user_ids=None, dataset_ids=None):
+    '''Select the (user_id, dataset_id, capacity) rows of
+    dataset_member_effective from the collaborators and core members tables'''
+    direct = select([
+        DatasetMember.member_id, DatasetMember.dataset_id,
+        DatasetMember.capacity]).where(DatasetMember.type == u'user')
+
+    through_org = select([
+        Member.table_id, DatasetMember.dataset_id, _effective_capacity()]).\
+        select_from(orm.join(DatasetMember, Member, and_(
+            Member.group_id == DatasetMember.member_id,
+            Member.table_name == u'user',
+            Member.state == u'active'))).\
+        where(DatasetMember.type == u'org')
+
+    if user_ids is not None:
+        direct = direct.where(DatasetMember.member_id.in_(user_ids))
+        through_org = through_org.where(Member.table_id.in_(user_ids))
+
+    if dataset_ids is not None:
+        direct = direct.where(DatasetMember.dataset_id.in_(dataset_ids))
+        through_org = through_org.where(
+            DatasetMember.dataset_id.in_(dataset_ids))
+
+    return union(direct, through_org)
+
+
+def refresh_effective(user_ids=None, dataset_ids=None):
+    '''Recompute dataset_member_effective for some users and/or datasets
+
+    Passing neither rebuilds the whole table. Pending changes are flushed
+    first, the session is not committed.
+    '''
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+    if dataset_ids is not None:
+        dataset_ids = list(dataset_ids)
+        if not dataset_ids:
+            return
+
+    Session.flush()
+
+    table = DatasetMemberEffective.__table__
+
+    delete = table.delete()
+    if user_ids is not None:
+        delete = delete.where(table.c.user_id.in_(user_ids))
+    if dataset_ids is not None:
+        delete = delete.where(table.c.dataset_id.in_(dataset_ids))
+    Session.execute(delete)
+
+    Session.execute(table.insert().from_select(
+        [table.c.user_id, table.c.dataset_id, table.c.capacity],
+        _effective_source(user_ids, dataset_ids)))
+
+
+def org_dataset_ids(org_id):
+    '''Return the ids of the datasets an organization collaborates in'''
+    return [dataset_id for (dataset_id,) in Session.query(
+        DatasetMember.dataset_id).filter(
+        DatasetMember.type == u'org',
+        DatasetMember.member_id == org_id)]
+
+
+def user_collaborations(user_id, capacities, member_type=None, after=None):
+    '''Return a query for the collaborations of a user
+
+    The query yields (DatasetMember, capacity) tuples for the user direct
+    memberships and those of the organizations the user belongs to, whose
+    `inherit` capacity is resolved by joining the core member table.
+
+    :param capacities: only return collaborations granting one of these
+    :param member_type: only return `user` or `org` collaborations
+    :param after: a (modified, id) tuple, only return collaborations sorting
+        after it
+    '''
+    queries = []
+
+    if member_type in (None, u'user'):
+        # Both branches label their capacity column, otherwise the repeated
+        # DatasetMember.capacity is deduplicated and the column counts differ
+        queries.append(Session.query(
+            DatasetMember,
+            DatasetMember.capacity.label(u'effective_capacity')).filter(
+            DatasetMember.type == u'user',
+            DatasetMember.member_id == user_id,
+            DatasetMember.capacity.in_(capacities)))
+
+    if member_type in (None, u'org'):
+        queries.append(Session.query(
+            DatasetMember,
+            _effective_capacity().label(u'effective_capacity')).join(
+            Member, _org_member_join(user_id)).filter(
+            DatasetMember.type == u'org',
+            _effective_capacity().in_(capacities)))
+
+    if after:
+        queries = [q.filter(
+            tuple_(DatasetMember.modified, DatasetMember.id) > tuple_(*after))
+            for q in queries]
+
+    if len(queries) == 1:
+        return queries[0]
+    return queries[0].union_all(*queries[1:])
+
+
+def dataset_owner_org(id_or_name):
+    '''Return the (id, name, owner_org) of a dataset, or None if not found'''
+    return Session.query(Package.id, Package.name, Package.owner_org).filter(
+        or_(Package.id == id_or_name, Package.name == id_or_name)).first()
+
+
+def dataset_members(dataset_id):
+    '''Return a (type, member_id, capacity) tuple for each collaborator of a
+    dataset, oldest first'''
+    return Session.query(
+        DatasetMember.type, DatasetMember.member_id, DatasetMember.capacity).\
+        filter(DatasetMember.dataset_id == dataset_id).\
+        order_by(DatasetMember.modified, DatasetMember.id).all()
+
+
+def ids_by_id_or_name(id_column, name_column, values):
+    '''Return a dict mapping each of the values found to its object id
+
+    Values can be ids or names, all of them are looked up with a single
+    query.
+    '''
+    values = list(set(values))
+    if not values:
+        return {}
+
+    out = {}
+    for obj_id, obj_name in Session.query(id_column, name_column).filter(
+            or_(id_column.in_(values), name_column.in_(values))):
+        out[obj_id] = obj_id
+        out[obj_name] = obj_id
+    return out
+
+
+def org_user_ids(org_id):
+    '''Return the ids of the users of an organization, including the ones
+    removed from it, whose memberships are kept with a deleted state'''
+    return [user_id for (user_id,) in Session.query(Member.table_id).filter(
+        Member.group_id == org_id,
+        Member.table_name == u'user').distinct()]
+
+
+def upsert_members(members):
+    '''Insert many dataset members, or update their capacity if they exist
+
+    :param members: dicts with the dataset_id, type, member_id and capacity
+        of each member. A (dataset_id, type, member_id) combination can only
+        appear once.
+
+    All members are written in a single INSERT ... ON CONFLICT statement. The
+    session is not committed.
+
+    Returns the stored members, as detached DatasetMember objects.
+    '''
+    if not members:
+        return []
+
+    now = datetime.datetime.utcnow()
+    table = DatasetMember.__table__
+
+    stmt = postgresql.insert(table).values(
+        [dict(member, id=make_uuid(), modified=now) for member in members])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.dataset_id, table.c.type, table.c.member_id],
+        set_={
+            u'capacity': stmt.excluded.capacity,
+            u'modified': stmt.excluded.modified,
+        }).returning(*table.c)
+
+    return [DatasetMember(**dict(row)) for row in Session.execute(stmt)]
+
+
+def import_members(members):
+    '''Insert many dataset members, or update their capacity if they exist
+
+    :param members: dicts with the dataset_id, type, member_id and capacity
+        of each member. A (dataset_id, type, member_id) combination can only
+        appear once.
+
+    Meant for large imports: members are loaded into a temporary table with
+    COPY, and then merged into dataset_member with a single INSERT ... ON
+    CONFLICT statement. Existing members whose capacity does not change are
+    left untouched. The session is not committed.
+
+    Returns an (inserted, updated) tuple with the number of members added
+    and changed.
+    '''
+    if not members:
+        return 0, 0
+
+    table = DatasetMember.__table__
+    staging = Table(
+        u'dataset_member_import', MetaData(),
+        *[Column(column.name, column.type) for column in table.c],
+        prefixes=[u'TEMPORARY'], postgresql_on_commit=u'DROP')
+    columns = [column.name for column in table.c]
+
+    now = datetime.datetime.utcnow().isoformat()
+    data = io.BytesIO()
+    writer = csv.writer(data)
+    for member in members:
+        values = dict(member, id=make_uuid(), modified=now)
+        writer.writerow([values[name].encode('utf-8') for name in columns])
+    data.seek(0)
+
+    connection = Session.connection()
+    staging.drop(bind=connection, checkfirst=True)
+    staging.create(bind=connection)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(u'COPY {} ({}) FROM STDIN WITH CSV'.format(
+        staging.name, u', '.join(columns)), data)
+
+    stmt = postgresql.insert(table).from_select(columns, select([staging]))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.dataset_id, table.c.type, table.c.member_id],
+        set_={
+            u'capacity': stmt.excluded.capacity,
+            u'modified': stmt.excluded.modified,
+        },
+        where=table.c.capacity != stmt.excluded.capacity)
+    # xmax is only 0 for the rows just inserted
+    stmt = stmt.returning(literal_column(u'xmax = 0'))
+
+    inserted = [row[0] for row in connection.execute(stmt)]
+    staging.drop(bind=connection)
+
+    return sum(inserted), len(inserted) - sum(inserted)
+
+
+def export_members(dataset_ids=None, owner_org=None, member_type=None,
+                   capacity=None, names=False, batch_size=1000):
+    '''Return an iterator over the dataset members matching the filters
+
+    Rows are streamed from a server-side cursor `batch_size` at a time, so
+    memory use does not grow with the number of members. Each row has the
+    dataset_id, type, member_id, capacity and modified columns, plus the
+    dataset_name and member_name if `names` is True.
+    '''
+    columns = [
+        DatasetMember.dataset_id, DatasetMember.type, DatasetMember.member_id,
+        DatasetMember.capacity, DatasetMember.modified]
+    if names:
+        columns.extend([
+            Package.name.label(u'dataset_name'),
+            func.coalesce(User.name, Group.name).label(u'member_name')])
+
+    q = Session.query(*columns)
+    if names or owner_org:
+        q = q.outerjoin(Package, Package.id == DatasetMember.dataset_id)
+    if names:
+        q = q.outerjoin(User, and_(
+            DatasetMember.type == u'user', User.id == DatasetMember.member_id))
+        q = q.outerjoin(Group, and_(
+            DatasetMember.type == u'org', Group.id == DatasetMember.member_id))
+
+    if dataset_ids is not None:
+        q = q.filter(DatasetMember.dataset_id.in_(dataset_ids))
+    if owner_org:
+        q = q.filter(Package.owner_org == owner_org)
+    if member_type:
+        q = q.filter(DatasetMember.type == member_type)
+    if capacity:
+        q = q.filter(DatasetMember.capacity == capacity)
+
+    return q.order_by(DatasetMember.dataset_id, DatasetMember.type,
+                      DatasetMember.member_id).yield_per(batch_size)
+
+
+def delete_members(*criteria):
+    '''Delete all the dataset members matching the criteria
+
+    Members are removed with a single DELETE statement. The session is not
+    committed.
+
+    Returns a (dataset_id, type, member_id, capacity) tuple for each deleted
+    member.
+    '''
+    table = DatasetMember.__table__
+    stmt = table.delete().where(and_(*criteria)).returning(
+        table.c.dataset_id, table.c.type, table.c.member_id, table.c.capacity)
+
+    return [tuple(row) for row in Session.execute(stmt)]
+
+
+def _orphaned_member_criteria():
+    return OrderedDict([
+        (u'dataset', ~exists().where(Package.id == DatasetMember.dataset_id)),
+        (u'user', and_(
+            DatasetMember.type == u'user',
+            ~exists().where(and_(
+                User.id == DatasetMember.member_id,
+                User.state != u'deleted')))),
+        (u'org', and_(
+            DatasetMember.type == u'org',
+            ~exists().where(and_(
+                Group.id == DatasetMember.member_id,
+                Group.state != u'deleted')))),
+    ])
+
+
+def orphaned_member_counts():
+    '''Return the number of members whose dataset was purged, and of
+    members whose user or organization was deleted
+
+    Counts are keyed by what is missing: dataset, user or org.
+    '''
+    return OrderedDict(
+        (kind, Session.query(func.count(DatasetMember.id)).filter(
+            criterion).scalar())
+        for kind, criterion in _orphaned_member_criteria().items())
+
+
+def delete_orphaned_members(limit=1000):
+    '''Delete up to `limit` members whose dataset was purged or whose user
+    or organization was deleted
+
+    Orphans are found with anti-joins (NOT EXISTS) against the package, user
+    and group tables. The session is not committed.
+
+    Returns a (dataset_id, type, member_id, capacity) tuple for each deleted
+    member.
+    '''
+    orphaned = select([DatasetMember.id]).where(
+        or_(*_orphaned_member_criteria().values())).limit(limit).\
+        correlate(None)
+    return delete_members(DatasetMember.id.in_(orphaned))
+
+
+def delete_orphaned_visibility():
+    '''Delete the stored visibility of resources that are not active any
+    more. The session is not committed.
+
+    Returns the number of rows deleted.
+    '''
+    table = ResourceVisibility.__table__
+    return Session.execute(table.delete().where(~exists().where(and_(
+        Resource.id == table.c.resource_id,
+        Resource.state == u'active')))).rowcount
+
+
+def resource_visibilities(package_id):
+    '''Return a (resource_id, visibility code) tuple for each active resource
+    of a dataset'''
+    return Session.query(
+        Resource.id,
+        func.coalesce(ResourceVisibility.visibility, VISIBILITY_PACKAGE)).\
+        outerjoin(
+            ResourceVisibility, ResourceVisibility.resource_id == Resource.id).\
+        filter(Resource.package_id == package_id,
+               Resource.state == u'active').all()
+
+
+def sync_resource_visibility(package_ids=None):
+    '''Store the visibility of the resources of some datasets
+
+    Passing no dataset ids syncs all resources. Only resources that are not
+    visible to everyone seeing the dataset get a row. Pending changes are
+    flushed first, the session is not committed.
+
+    Returns the number of resources with a restricted visibility.
+    '''
+    if package_ids is not None:
+        package_ids = list(package_ids)
+        if not package_ids:
+            return 0
+
+    Session.flush()
+
+    table = ResourceVisibility.__table__
+    delete = table.delete()
+    q = Session.query(Resource).filter(Resource.state == u'active')
+    if package_ids is not None:
+        delete = delete.where(table.c.package_id.in_(package_ids))
+        q = q.filter(Resource.package_id.in_(package_ids))
+    Session.execute(delete)
+
+    rows = []
+    count = 0
+    for resource in q.yield_per(1000):
+        code = visibility_code(resource.extras.get(u'visibility'))
+        if code != VISIBILITY_PACKAGE:
+            rows.append({
+                u'resource_id': resource.id,
+                u'package_id': resource.package_id,
+                u'visibility': code,
+            })
+        if len(rows) >= 1000:
+            Session.execute(table.insert(), rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        Session.execute(table.insert(), rows)
+        count += len(rows)
+
+    return count
+
+
 def create_tables():
-    DatasetMember.__table__.create()
+    metadata.create_all(tables=TABLES)
 
     log.info(u'Dataset collaborators database tables created')
 
 def drop_tables():
-    DatasetMember.__table__.drop()
+    metadata.drop_all(tables=TABLES)
 
     log.info(u'Dataset collaborators database tables dropped')
 
@@ -57,3 +582,83 @@ def drop_tables():
 def tables_exist():
     
     return DatasetMember.__table__.exists() 
+
+
+def missing_tables():
+    '''Return the collaborators tables not present in the database'''
+    return [table for table in TABLES if not table.exists()]
+
+
+def invalid_index_names():
+    '''Return the names of the collaborators indexes marked as invalid
+
+    A failed or interrupted CREATE INDEX CONCURRENTLY leaves the index
+    behind, but queries can not use it until it is rebuilt.
+    '''
+    names = [index.name for table in TABLES for index in table.indexes]
+    rows = metadata.bind.execute(text(
+        u'SELECT c.relname FROM pg_index i '
+        u'JOIN pg_class c ON c.oid = i.indexrelid '
+        u'WHERE NOT i.indisvalid AND c.relname = ANY(:names)'), names=names)
+    return set(name for (name,) in rows)
+
+
+def missing_indexes():
+    '''Return the collaborators indexes not present in the database, or
+    present but invalid'''
+    inspector = inspect(metadata.bind)
+    invalid = invalid_index_names()
+    missing = []
+    for table in TABLES:
+        existing = set(
+            index[u'name'] for index in inspector.get_indexes(table.name))
+        missing.extend(
+            index for index in table.indexes
+            if index.name not in existing or index.name in invalid)
+
+    return missing
+
+
+def duplicate_members():
+    '''Return the (dataset_id, type, member_id) tuples stored more than once
+
+    These need to be cleaned up before the unique index can be built.
+    '''
+    return Session.query(
+        DatasetMember.dataset_id, DatasetMember.type, DatasetMember.member_id).\
+        group_by(
+            DatasetMember.dataset_id, DatasetMember.type, DatasetMember.member_id).\
+        having(func.count(DatasetMember.id) > 1).all()
+
+
+def create_indexes():
+    '''Build any missing dataset_member index on an existing install
+
+    Indexes are built with CREATE INDEX CONCURRENTLY, which can not run inside
+    a transaction block but does not lock the table against writes. Invalid
+    indexes left by a previous failed build are dropped and built again.
+    Missing tables need to be created first.
+    '''
+    connection = metadata.bind.connect().execution_options(
+        isolation_level=u'AUTOCOMMIT')
+    created = []
+    try:
+        invalid = invalid_index_names()
+        for index in missing_indexes():
+            if index.name in invalid:
+                connection.execute(
+                    u'DROP INDEX CONCURRENTLY IF EXISTS {}'.format(index.name))
+                log.info(u'Invalid dataset collaborators index {} '
+                         u'dropped'.format(index.name))
+            connection.execute(
+                u'CREATE {unique}INDEX CONCURRENTLY {name} ON {table} ({columns})'.format(
+                    unique=u'UNIQUE ' if index.unique else u'',
+                    name=index.name,
+                    table=index.table.name,
+                    columns=u', '.join(column.name for column in index.columns)))
+            created.append(index.name)
+            log.info(u'Dataset collaborators index {} created'.format(index.name))
+    finally:
+        connection.close()
+
+    return created
@@ -3,11 +3,19 @@ import logging
 import ckan.plugins as p
 from ckan.lib.plugins import DefaultPermissionLabels
 import ckan.plugins.toolkit as toolkit
+from ckan.authz import get_roles_with_permission
 
 from ckanext.collaborators import blueprint
-from ckanext.collaborators.helpers import (get_collaborators, get_resource_visibility_options)
-from ckanext.collaborators.model import tables_exist
+from ckanext.collaborators.cache import (
+    get_user_memberships, labels_cache, invalidate_member)
+from ckanext.collaborators.helpers import (
+    get_collaborators, get_collaborators_for_display, get_visible_resources,
+    get_resource_visibility_options)
+from ckanext.collaborators.model import (
+    missing_tables, refresh_effective, org_dataset_ids, sync_resource_visibility,
+    delete_members, DatasetMember)
 from ckanext.collaborators.logic import action, auth
+from ckanext.collaborators.instrumentation import instrument_all
 
 log = logging.getLogger(__name__)
 
@@ -19,16 +27,19 @@ class CollaboratorsPlugin(p.SingletonPlugin, DefaultPermissionLabels):
     p.implements(p.IPermissionLabels)
     p.implements(p.IBlueprint)
     p.implements(p.ITemplateHelpers)
+    p.implements(p.IOrganizationController, inherit=True)
+    p.implements(p.IPackageController, inherit=True)
 
     # IConfigurer
 
     def update_config(self, config_):
-        if not tables_exist():
+        missing = missing_tables()
+        if missing:
             log.critical(u'''
-The dataset collaborators extension requires a database setup. Please run the
-following to create the database tables:
-    paster --plugin=ckanext-collaborators collaborators init-db
-''')
+The dataset collaborators extension requires a database setup, the {} tables
+are missing. Please run the following to create or upgrade them:
+    paster --plugin=ckanext-collaborators collaborators upgrade-db
+'''.format(u', '.join(table.name for table in missing)))
 
         toolkit.add_template_directory(config_, 'templates')
         toolkit.add_public_directory(config_, 'public')
@@ -37,23 +48,38 @@ following to create the database tables:
     # IActions
 
     def get_actions(self):
-        return {
+        return instrument_all({
             'dataset_collaborator_create': action.dataset_collaborator_create,
+            'dataset_collaborator_create_many': action.dataset_collaborator_create_many,
             'dataset_collaborator_delete': action.dataset_collaborator_delete,
+            'dataset_collaborator_delete_many': action.dataset_collaborator_delete_many,
             'dataset_collaborator_list': action.dataset_collaborator_list,
+            'dataset_collaborator_show': action.dataset_collaborator_show,
+            'dataset_collaborator_list_many': action.dataset_collaborator_list_many,
             'dataset_collaborator_list_for_user': action.dataset_collaborator_list_for_user,
-        }
+            'collaborators_cache_stats': action.collaborators_cache_stats,
+            'collaborators_stats': action.collaborators_stats,
+            'member_create': action.member_create,
+            'member_delete': action.member_delete,
+            'dataset_purge': action.dataset_purge,
+            'user_delete': action.user_delete,
+        }, 'action')
 
     # IAuthFunctions
 
     def get_auth_functions(self):
-        return {
+        return instrument_all({
             'dataset_collaborator_create': auth.dataset_collaborator_create,
             'dataset_collaborator_delete': auth.dataset_collaborator_delete,
             'dataset_collaborator_list': auth.dataset_collaborator_list,
+            'dataset_collaborator_show': auth.dataset_collaborator_show,
+            'dataset_collaborator_list_many': auth.dataset_collaborator_list_many,
             'dataset_collaborator_list_for_user': auth.dataset_collaborator_list_for_user,
+            'collaborators_cache_stats': auth.collaborators_cache_stats,
+            'collaborators_stats': auth.collaborators_stats,
             'package_update': auth.package_update,
-        }
+            'resource_show': auth.resource_show,
+        }, 'auth')
 
     # IPermissionLabels
 
@@ -74,17 +100,64 @@ following to create the database tables:
             return labels
 
         # Add a label for each dataset this user is a collaborator of
-        datasets = toolkit.get_action('dataset_collaborator_list_for_user')(
-                {'ignore_auth': True}, {'id': user_obj.id})
-
-        for dataset in datasets:
-            labels.append('collaborator-{}'.format(dataset['dataset_id']))
-
-        return labels
+        cache = labels_cache()
+        collaborator_labels, version = cache.get(user_obj.id)
+        if collaborator_labels is None:
+            roles = get_roles_with_permission('manage_group')
+            memberships = get_user_memberships(user_obj.id)
+
+            collaborator_labels = [
+                'collaborator-{}'.format(dataset_id)
+                for dataset_id, capacities in memberships.items()
+                if any(capacity in roles for capacity in capacities)]
+            cache.set(user_obj.id, collaborator_labels, version)
+
+        return labels + collaborator_labels
+
+    # IOrganizationController
+
+    def edit(self, entity):
+        # Also called for datasets, as IPackageController shares the name
+        if not getattr(entity, 'is_organization', False):
+            return
+
+        # Organization users might have changed, update the permissions they
+        # get on the datasets the organization collaborates in
+        dataset_ids = org_dataset_ids(entity.id)
+        if dataset_ids:
+            refresh_effective(dataset_ids=dataset_ids)
+            invalidate_member('org', entity.id)
+
+    def delete(self, entity):
+        # Also called for datasets, which keep their collaborators in case
+        # they are restored
+        if not getattr(entity, 'is_organization', False):
+            return
+
+        # The organization stops being a collaborator in all its datasets.
+        # The changes are committed by organization_delete
+        deleted = delete_members(
+            DatasetMember.type == u'org', DatasetMember.member_id == entity.id)
+        if deleted:
+            dataset_ids = set(row[0] for row in deleted)
+            refresh_effective(dataset_ids=dataset_ids)
+            invalidate_member('org', entity.id)
+
+    # IPackageController
+
+    def after_create(self, context, pkg_dict):
+        sync_resource_visibility([pkg_dict['id']])
+
+    def after_update(self, context, pkg_dict):
+        # Resource changes go through package_update, so this covers
+        # resource_create, resource_update and resource_delete too
+        sync_resource_visibility([pkg_dict['id']])
 
     # ITemplateHelpers
     def get_helpers(self):
         return {'collaborators_get_collaborators': get_collaborators,
+        'collaborators_get_collaborators_for_display': get_collaborators_for_display,
+        'collaborators_get_visible_resources': get_visible_resources,
         'collaborators_get_resource_visibility_options': get_resource_visibility_options}
 
     # IBlueprint
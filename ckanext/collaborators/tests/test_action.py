@@ -6,6 +6,7 @@ from ckan import model
 from ckan.plugins import toolkit
 from ckan.tests import helpers, factories
 
+from ckanext.collaborators import jobs
 from ckanext.collaborators.model import DatasetMember
 from ckanext.collaborators.tests import FunctionalTestBase
 
@@ -181,6 +182,52 @@ class TestCollaboratorsActions(FunctionalTestBase):
             'dataset_collaborator_list',
             id=dataset['id'], user_id=user['id'], capacity=capacity)
 
+    def test_show(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='inherit')
+
+        member = helpers.call_action(
+            'dataset_collaborator_show',
+            id=dataset['name'], type='org', member_id=org['id'])
+
+        assert_equals(member['dataset_id'], dataset['id'])
+        assert_equals(member['type'], 'org')
+        assert_equals(member['member_id'], org['id'])
+        assert_equals(member['capacity'], 'inherit')
+
+    def test_show_not_a_collaborator(self):
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action,
+            'dataset_collaborator_show',
+            id=dataset['id'], type='user', member_id=user['id'])
+
+    def test_show_dataset_not_found(self):
+        user = factories.User()
+
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action,
+            'dataset_collaborator_show',
+            id='xxx', type='user', member_id=user['id'])
+
+    def test_show_wrong_type(self):
+        dataset = factories.Dataset()
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_show',
+            id=dataset['id'], type='group', member_id='xxx')
+
     def test_list_for_user(self):
 
         dataset1 = factories.Dataset()
@@ -250,6 +297,467 @@ class TestCollaboratorsActions(FunctionalTestBase):
             id=user['id'], capacity=capacity)
 
 
+class TestCollaboratorsListForUser(FunctionalTestBase):
+
+    def _create_collaborations(self, user, count):
+        datasets = [factories.Dataset() for i in range(count)]
+        for dataset in datasets:
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], type='user', member_id=user['id'],
+                capacity='editor')
+        return [dataset['id'] for dataset in datasets]
+
+    def test_list_for_user_limit_offset(self):
+
+        user = factories.User()
+        dataset_ids = self._create_collaborations(user, 5)
+
+        page1 = helpers.call_action(
+            'dataset_collaborator_list_for_user',
+            id=user['id'], limit=2)
+        page2 = helpers.call_action(
+            'dataset_collaborator_list_for_user',
+            id=user['id'], limit=2, offset=2)
+        page3 = helpers.call_action(
+            'dataset_collaborator_list_for_user',
+            id=user['id'], limit=2, offset=4)
+
+        assert_equals(
+            [d['dataset_id'] for d in page1 + page2 + page3], dataset_ids)
+
+    def test_list_for_user_keyset(self):
+
+        user = factories.User()
+        dataset_ids = self._create_collaborations(user, 5)
+
+        results = []
+        page = helpers.call_action(
+            'dataset_collaborator_list_for_user', id=user['id'], limit=2)
+        while page:
+            results.extend(page)
+            page = helpers.call_action(
+                'dataset_collaborator_list_for_user',
+                id=user['id'], limit=2,
+                after_modified=page[-1]['modified'], after_id=page[-1]['id'])
+
+        assert_equals([d['dataset_id'] for d in results], dataset_ids)
+
+    def test_list_for_user_keyset_incomplete(self):
+
+        user = factories.User()
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_list_for_user',
+            id=user['id'], after_id='xxx')
+
+    def test_list_for_user_org_inherit(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'admin'}])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='inherit')
+
+        datasets = helpers.call_action(
+            'dataset_collaborator_list_for_user', id=user['id'])
+
+        assert_equals(len(datasets), 1)
+        assert_equals(datasets[0]['dataset_id'], dataset['id'])
+        assert_equals(datasets[0]['type'], 'org')
+        assert_equals(datasets[0]['capacity'], 'editor')
+
+    def test_list_for_user_direct_and_org(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'member'}])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset1['id'], type='user', member_id=user['id'],
+            capacity='editor')
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset2['id'], type='org', member_id=org['id'],
+            capacity='inherit')
+
+        datasets = helpers.call_action(
+            'dataset_collaborator_list_for_user', id=user['id'])
+
+        assert_equals(
+            [(d['dataset_id'], d['type'], d['capacity']) for d in datasets],
+            [(dataset1['id'], 'user', 'editor'),
+             (dataset2['id'], 'org', 'member')])
+
+
+class TestCollaboratorsBulkActions(FunctionalTestBase):
+
+    def test_create_many(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization()
+
+        results = helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': dataset1['id'], 'type': 'user',
+                 'member_id': user['id'], 'capacity': 'editor'},
+                {'id': dataset2['name'], 'type': 'user',
+                 'member_id': user['name'], 'capacity': 'member'},
+                {'id': dataset2['id'], 'type': 'org',
+                 'member_id': org['name'], 'capacity': 'inherit'},
+            ])
+
+        assert_equals([r['success'] for r in results], [True, True, True])
+        assert_equals(results[1]['collaborator']['dataset_id'], dataset2['id'])
+        assert_equals(results[1]['collaborator']['member_id'], user['id'])
+        assert_equals(results[2]['collaborator']['capacity'], 'inherit')
+
+        assert_equals(model.Session.query(DatasetMember).count(), 3)
+
+    def test_create_many_updates_existing(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+
+        helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': dataset['id'], 'type': 'user',
+                 'member_id': user['id'], 'capacity': 'member'},
+            ])
+
+        assert_equals(model.Session.query(DatasetMember).count(), 1)
+        assert_equals(model.Session.query(DatasetMember).one().capacity,
+            'member')
+
+    def test_create_many_errors_per_item(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        results = helpers.call_action(
+            'dataset_collaborator_create_many',
+            collaborators=[
+                {'id': 'xxx', 'type': 'user',
+                 'member_id': user['id'], 'capacity': 'editor'},
+                {'id': dataset['id'], 'type': 'user',
+                 'member_id': 'xxx', 'capacity': 'editor'},
+                {'id': dataset['id'], 'type': 'user',
+                 'member_id': user['id'], 'capacity': 'inherit'},
+                {'id': dataset['id'], 'type': 'user',
+                 'member_id': user['id'], 'capacity': 'editor'},
+            ])
+
+        assert_equals([r['success'] for r in results],
+            [False, False, False, True])
+        assert_equals(results[0]['error'], 'Dataset not found')
+        assert_equals(results[1]['error'], 'User not found')
+
+        assert_equals(model.Session.query(DatasetMember).count(), 1)
+
+    def test_create_many_auth_checked_once_per_org(self):
+        user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'admin'}])
+        datasets = [factories.Dataset(owner_org=org['id']) for i in range(3)]
+        collaborator = factories.User()
+
+        with mock.patch(
+                'ckanext.collaborators.logic.auth.'
+                'has_user_permission_for_group_or_org',
+                return_value=True) as mock_permission:
+            results = helpers.call_action(
+                'dataset_collaborator_create_many',
+                context={'user': user['name'], 'ignore_auth': False},
+                collaborators=[{
+                    'id': dataset['id'], 'type': 'user',
+                    'member_id': collaborator['id'], 'capacity': 'member',
+                } for dataset in datasets])
+
+        assert all(result['success'] for result in results)
+        assert_equals(mock_permission.call_count, 1)
+
+    def test_create_many_missing_fields(self):
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_create_many',
+            collaborators=[{'id': 'xxx', 'type': 'user'}])
+
+
+    def test_delete_many(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+
+        for dataset in (dataset1, dataset2):
+            for user in (user1, user2):
+                helpers.call_action(
+                    'dataset_collaborator_create',
+                    id=dataset['id'], type='user', member_id=user['id'],
+                    capacity='editor')
+
+        result = helpers.call_action(
+            'dataset_collaborator_delete_many',
+            collaborators=[
+                {'id': dataset1['name'], 'type': 'user',
+                 'member_id': user1['name']},
+                {'id': dataset2['id'], 'type': 'user',
+                 'member_id': user2['id']},
+            ])
+
+        assert_equals(result['count'], 2)
+        assert_equals(result['datasets'],
+            {dataset1['id']: 1, dataset2['id']: 1})
+        assert_equals(model.Session.query(DatasetMember).count(), 2)
+
+    def test_delete_many_by_member(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+
+        for dataset in (dataset1, dataset2):
+            for user in (user1, user2):
+                helpers.call_action(
+                    'dataset_collaborator_create',
+                    id=dataset['id'], type='user', member_id=user['id'],
+                    capacity='editor')
+
+        result = helpers.call_action(
+            'dataset_collaborator_delete_many',
+            type='user', member_id=user1['name'])
+
+        assert_equals(result['count'], 2)
+        assert_equals(
+            set(m.member_id for m in model.Session.query(DatasetMember)),
+            set([user2['id']]))
+
+    def test_delete_many_by_dataset(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization()
+
+        for dataset in (dataset1, dataset2):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], type='user', member_id=user['id'],
+                capacity='editor')
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset1['id'], type='org', member_id=org['id'],
+            capacity='member')
+
+        result = helpers.call_action(
+            'dataset_collaborator_delete_many', id=dataset1['id'])
+
+        assert_equals(result, {'count': 2, 'datasets': {dataset1['id']: 2}})
+        assert_equals(model.Session.query(DatasetMember).one().dataset_id,
+            dataset2['id'])
+
+    def test_delete_many_auth_checked_once_per_org(self):
+        user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'admin'}])
+        datasets = [factories.Dataset(owner_org=org['id']) for i in range(3)]
+        collaborator = factories.User()
+        for dataset in datasets:
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], type='user', member_id=collaborator['id'],
+                capacity='member')
+
+        with mock.patch(
+                'ckanext.collaborators.logic.auth.'
+                'has_user_permission_for_group_or_org',
+                return_value=True) as mock_permission:
+            result = helpers.call_action(
+                'dataset_collaborator_delete_many',
+                context={'user': user['name'], 'ignore_auth': False},
+                type='user', member_id=collaborator['id'])
+
+        assert_equals(result['count'], 3)
+        assert_equals(mock_permission.call_count, 1)
+
+    def test_delete_many_not_authorized_on_one_org(self):
+        user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'admin'}])
+        datasets = [factories.Dataset(owner_org=org['id']),
+                    factories.Dataset(owner_org=factories.Organization()['id'])]
+        collaborator = factories.User()
+        for dataset in datasets:
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], type='user', member_id=collaborator['id'],
+                capacity='member')
+
+        assert_raises(
+            toolkit.NotAuthorized, helpers.call_action,
+            'dataset_collaborator_delete_many',
+            context={'user': user['name'], 'ignore_auth': False},
+            type='user', member_id=collaborator['id'])
+
+        assert_equals(model.Session.query(DatasetMember).count(), 2)
+
+    def test_delete_many_no_criteria(self):
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_delete_many')
+
+
+    def test_list_many(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        dataset3 = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset1['id'], type='user', member_id=user['id'],
+            capacity='editor')
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset2['id'], type='org', member_id=org['id'],
+            capacity='member')
+
+        result = helpers.call_action(
+            'dataset_collaborator_list_many',
+            ids=[dataset1['id'], dataset2['name'], dataset3['id']])
+
+        assert_equals(sorted(result.keys()),
+            sorted([dataset1['id'], dataset2['id'], dataset3['id']]))
+        assert_equals(result[dataset1['id']][0]['member_id'], user['id'])
+        assert_equals(result[dataset2['id']][0]['member_id'], org['id'])
+        assert_equals(result[dataset3['id']], [])
+
+    def test_list_many_with_type(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='member')
+
+        result = helpers.call_action(
+            'dataset_collaborator_list_many', ids=[dataset['id']], type='org')
+
+        assert_equals(len(result[dataset['id']]), 1)
+        assert_equals(result[dataset['id']][0]['type'], 'org')
+
+    def test_list_many_dataset_not_found(self):
+
+        assert_raises(toolkit.ObjectNotFound, helpers.call_action,
+            'dataset_collaborator_list_many', ids=['xxx'])
+
+    @helpers.change_config('ckanext.collaborators.list_many_limit', 1)
+    def test_list_many_limit(self):
+
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+
+        assert_raises(toolkit.ValidationError, helpers.call_action,
+            'dataset_collaborator_list_many',
+            ids=[dataset1['id'], dataset2['id']])
+
+
+class TestCollaboratorsCleanup(FunctionalTestBase):
+
+    def _members(self):
+        return sorted(model.Session.query(
+            DatasetMember.dataset_id, DatasetMember.type,
+            DatasetMember.member_id))
+
+    def test_dataset_purge(self):
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        user = factories.User()
+
+        for dataset in (dataset1, dataset2):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], type='user', member_id=user['id'],
+                capacity='editor')
+
+        helpers.call_action('dataset_purge', id=dataset1['id'])
+
+        assert_equals(self._members(), [(dataset2['id'], 'user', user['id'])])
+
+    def test_user_delete(self):
+        dataset = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+
+        for user in (user1, user2):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], type='user', member_id=user['id'],
+                capacity='editor')
+
+        helpers.call_action('user_delete', id=user1['id'])
+
+        assert_equals(self._members(), [(dataset['id'], 'user', user2['id'])])
+
+    def test_organization_delete(self):
+        dataset = factories.Dataset()
+        org = factories.Organization()
+        user = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='member')
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='member')
+
+        helpers.call_action('organization_delete', id=org['id'])
+
+        assert_equals(self._members(), [(dataset['id'], 'user', user['id'])])
+
+    def test_dataset_delete_keeps_collaborators(self):
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+
+        helpers.call_action('package_delete', id=dataset['id'])
+
+        assert_equals(self._members(), [(dataset['id'], 'user', user['id'])])
+
+
 class TestCollaboratorsSearch(FunctionalTestBase):
 
     def test_search_results_editor(self):
@@ -308,30 +816,100 @@ class TestCollaboratorsSearch(FunctionalTestBase):
         assert_equals(results['results'][0]['id'], dataset1['id'])
         assert_equals(results['results'][1]['id'], dataset2['id'])
 
-    @mock.patch('ckanext.collaborators.mailer.mail_user')
-    def test_create_collaborator_emails_notification(self, mock_mail_user):
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_create_collaborator_queues_notification(self, mock_enqueue):
         dataset = factories.Dataset()
         user = factories.User()
         capacity = 'editor'
 
-        member = helpers.call_action(
+        helpers.call_action(
             'dataset_collaborator_create',
-            id=dataset['id'], user_id=user['id'], capacity=capacity)
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity=capacity)
 
-        assert_equals(mock_mail_user.call_count, 1)
+        notifications = [c for c in mock_enqueue.call_args_list
+                         if c[0][0] == jobs.send_notification]
+        assert_equals(len(notifications), 1)
+        assert_equals(notifications[0][0][1],
+                      [dataset['id'], user['id'], capacity, 'create'])
 
-    @mock.patch('ckanext.collaborators.mailer.mail_user')
-    def test_delete_collaborators_emails_notification(self, mock_mail_user):
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_delete_collaborator_queues_notification(self, mock_enqueue):
         dataset = factories.Dataset()
         user = factories.User()
         capacity = 'editor'
 
-        member = helpers.call_action(
+        helpers.call_action(
             'dataset_collaborator_create',
-            id=dataset['id'], user_id=user['id'], capacity=capacity)
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity=capacity)
 
         helpers.call_action(
             'dataset_collaborator_delete',
-            id=dataset['id'], user_id=user['id'])
+            id=dataset['id'], type='user', member_id=user['id'])
+
+        notifications = [c[0][1] for c in mock_enqueue.call_args_list
+                         if c[0][0] == jobs.send_notification]
+        assert_equals(notifications, [
+            [dataset['id'], user['id'], capacity, 'create'],
+            [dataset['id'], user['id'], capacity, 'delete'],
+        ])
+
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_delete_many_queues_notifications(self, mock_enqueue):
+        dataset1 = factories.Dataset()
+        dataset2 = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization()
+
+        for dataset, capacity in ((dataset1, 'editor'), (dataset2, 'member')):
+            helpers.call_action(
+                'dataset_collaborator_create',
+                id=dataset['id'], type='user', member_id=user['id'],
+                capacity=capacity)
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset1['id'], type='org', member_id=org['id'],
+            capacity='member')
+        mock_enqueue.reset_mock()
+
+        helpers.call_action(
+            'dataset_collaborator_delete_many',
+            collaborators=[
+                {'id': dataset1['id'], 'type': 'user', 'member_id': user['id']},
+                {'id': dataset2['id'], 'type': 'user', 'member_id': user['id']},
+                {'id': dataset1['id'], 'type': 'org', 'member_id': org['id']},
+            ])
+
+        notifications = [c[0][1] for c in mock_enqueue.call_args_list
+                         if c[0][0] == jobs.send_notification]
+        assert_equals(sorted(notifications), sorted([
+            [dataset1['id'], user['id'], 'editor', 'delete'],
+            [dataset2['id'], user['id'], 'member', 'delete'],
+        ]))
+
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job',
+                side_effect=Exception('Redis is down'))
+    def test_queueing_errors_do_not_fail_committed_changes(self, mock_enqueue):
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+
+        assert_equals(model.Session.query(DatasetMember).count(), 1)
+
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_org_collaborators_not_notified(self, mock_enqueue):
+        dataset = factories.Dataset()
+        org = factories.Organization()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='member')
 
-        assert_equals(mock_mail_user.call_count, 2)
+        assert not [c for c in mock_enqueue.call_args_list
+                    if c[0][0] == jobs.send_notification]
@@ -6,6 +6,7 @@ from ckan.plugins import (
     load as load_plugin, unload as unload_plugin)
 from ckan.tests import helpers, factories
 
+from ckanext.collaborators.logic.auth import visible_resource_ids
 from ckanext.collaborators.tests import FunctionalTestBase
 
 
@@ -181,6 +182,31 @@ class TestCollaboratorsAuth(CollaboratorsAuthTestBase, FunctionalTestBase):
             context=context, id=self.normal_user['id'])
 
 
+    def test_list_many_org_admin_is_authorized(self):
+
+        dataset2 = factories.Dataset(owner_org=self.org['id'])
+
+        context = self._get_context(self.org_admin)
+        assert helpers.call_auth('dataset_collaborator_list_many',
+            context=context, ids=[self.dataset['id'], dataset2['id']])
+
+    def test_list_many_other_org_dataset_is_not_authorized(self):
+
+        dataset2 = factories.Dataset(owner_org=self.org2['id'])
+
+        context = self._get_context(self.org_admin)
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+            'dataset_collaborator_list_many',
+            context=context, ids=[self.dataset['id'], dataset2['id']])
+
+    def test_list_many_org_editor_is_not_authorized(self):
+
+        context = self._get_context(self.org_editor)
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+            'dataset_collaborator_list_many',
+            context=context, ids=[self.dataset['id']])
+
+
 class TestCollaboratorsShow(CollaboratorsAuthTestBase, FunctionalTestBase):
 
     _load_plugins = ['image_view']
@@ -872,3 +898,145 @@ class TestCollaboratorsDataStore(CollaboratorsAuthTestBase, FunctionalTestBase):
         assert_raises(toolkit.NotAuthorized, helpers.call_auth,
             'datastore_delete',
             context=context, resource_id=resource['id'])
+
+
+class TestCollaboratorsUpdateOrg(CollaboratorsAuthTestBase, FunctionalTestBase):
+
+    def test_dataset_update_org_editor(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        user = factories.User()
+        collaborator_org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'member'}])
+
+        context = self._get_context(user)
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+            'package_update',
+            context=context, id=dataset['id'])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=collaborator_org['id'],
+            capacity='editor')
+
+        assert helpers.call_auth('package_update',
+            context=context, id=dataset['id'])
+
+    def test_dataset_update_org_inherit_editor(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        user = factories.User()
+        collaborator_org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'editor'}])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=collaborator_org['id'],
+            capacity='inherit')
+
+        context = self._get_context(user)
+        assert helpers.call_auth('package_update',
+            context=context, id=dataset['id'])
+
+    def test_dataset_update_org_inherit_member(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+        user = factories.User()
+        collaborator_org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'member'}])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=collaborator_org['id'],
+            capacity='inherit')
+
+        context = self._get_context(user)
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+            'package_update',
+            context=context, id=dataset['id'])
+
+
+class TestCollaboratorsResourceVisibility(CollaboratorsAuthTestBase, FunctionalTestBase):
+
+    def setup(self):
+
+        super(TestCollaboratorsResourceVisibility, self).setup()
+
+        self.org = factories.Organization()
+        self.dataset = factories.Dataset(owner_org=self.org['id'])
+        self.public = factories.Resource(
+            package_id=self.dataset['id'], visibility='package')
+        self.editor_only = factories.Resource(
+            package_id=self.dataset['id'], visibility='editor')
+        self.collaborator_only = factories.Resource(
+            package_id=self.dataset['id'], visibility='collaborator_member')
+        self.owner_only = factories.Resource(
+            package_id=self.dataset['id'], visibility='owner_member')
+
+    def _visible(self, user):
+        context = self._get_context(user)
+        context['auth_user_obj'] = model.User.get(user['id'])
+        return visible_resource_ids(
+            context, model.Package.get(self.dataset['id']))
+
+    def test_visible_resources_normal_user(self):
+
+        user = factories.User()
+
+        assert_equals(self._visible(user), set([self.public['id']]))
+
+    def test_visible_resources_collaborator_member(self):
+
+        user = factories.User()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=self.dataset['id'], type='user', member_id=user['id'],
+            capacity='member')
+
+        assert_equals(self._visible(user),
+            set([self.public['id'], self.collaborator_only['id']]))
+
+    def test_visible_resources_collaborator_editor(self):
+
+        user = factories.User()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=self.dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+
+        assert_equals(self._visible(user), set([
+            self.public['id'], self.editor_only['id'],
+            self.collaborator_only['id']]))
+
+    def test_visible_resources_org_member(self):
+
+        user = factories.User()
+        helpers.call_action(
+            'organization_member_create',
+            id=self.org['id'], username=user['name'], role='member')
+
+        assert_equals(self._visible(user), set([
+            self.public['id'], self.collaborator_only['id'],
+            self.owner_only['id']]))
+
+    def test_resource_show(self):
+
+        user = factories.User()
+        context = self._get_context(user)
+
+        assert helpers.call_auth('resource_show',
+            context=context, id=self.public['id'])
+        assert_raises(toolkit.NotAuthorized, helpers.call_auth,
+            'resource_show',
+            context=context, id=self.editor_only['id'])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=self.dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+
+        assert helpers.call_auth('resource_show',
+            context=self._get_context(user), id=self.editor_only['id'])
@@ -0,0 +1,55 @@
+from nose.tools import assert_equals, assert_raises
+
+from ckan import model
+
+from ckanext.collaborators import benchmark
+from ckanext.collaborators.model import DatasetMember
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestBenchmark(FunctionalTestBase):
+
+    def test_run(self):
+
+        results = benchmark.run(
+            scales=[1, 2], datasets=4, users=4, orgs=2, members=6,
+            iterations=3)
+
+        assert_equals(list(results['results'].keys()), ['1', '2'])
+        paths = results['results']['2']
+        assert_equals(paths['counts']['datasets'], 8)
+        for name in ('dataset_collaborator_list',
+                     'dataset_collaborator_list_for_user',
+                     'auth.package_update', 'auth.resource_show',
+                     'get_user_dataset_labels'):
+            assert paths[name]['p50_ms'] <= paths[name]['p99_ms']
+            assert paths[name]['queries'] > 0
+
+        # The synthetic data is removed
+        assert_equals(model.Session.query(model.Package).count(), 0)
+        assert_equals(model.Session.query(DatasetMember).count(), 0)
+
+    def test_more_orgs_than_users(self):
+
+        results = benchmark.run(
+            datasets=4, users=2, orgs=3, members=2, iterations=2)
+
+        assert results['results']['1']['dataset_collaborator_list']['queries']
+
+    def test_counts_validated(self):
+
+        assert_raises(ValueError, benchmark.run, users=0)
+
+    def test_compare(self):
+
+        def results(p50):
+            return {'results': {'1': {
+                'counts': {},
+                'auth.package_update': {'p50_ms': p50}}}}
+
+        assert_equals(
+            [c[-1] for c in benchmark.compare(results(1.1), results(1.0))],
+            [False])
+        assert_equals(
+            [c[-1] for c in benchmark.compare(results(1.5), results(1.0))],
+            [True])
@@ -0,0 +1,356 @@
+import mock
+import fakeredis
+
+from nose.tools import assert_equals, assert_raises
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckan.tests import helpers, factories
+
+from ckanext.collaborators import cache
+from ckanext.collaborators.model import DatasetMember, refresh_effective
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestRequestCache(FunctionalTestBase):
+
+    def test_memberships_cached_per_request(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+
+        app = self._get_test_app()
+        with app.flask_app.test_request_context():
+            with mock.patch('ckanext.collaborators.cache.user_memberships',
+                    wraps=cache.user_memberships) as mock_memberships:
+
+                assert cache.user_has_capacity(
+                    user['id'], dataset['id'], ['editor'])
+                assert_equals(
+                    cache.get_user_memberships(user['id']),
+                    {dataset['id']: set(['editor'])})
+
+                assert_equals(mock_memberships.call_count, 1)
+
+                cache.invalidate_member('user', user['id'])
+                cache.get_user_memberships(user['id'])
+
+                assert_equals(mock_memberships.call_count, 2)
+
+    def test_visible_resources_dropped_when_members_change(self):
+
+        app = self._get_test_app()
+        with app.flask_app.test_request_context():
+            for name in ('memberships', 'owner_orgs', 'visible_resources'):
+                cache.request_cache(name)['key'] = 'value'
+
+            cache.invalidate_member('user', 'some-user')
+
+            for name in ('memberships', 'owner_orgs', 'visible_resources'):
+                assert_equals(cache.request_cache(name), {})
+
+    def test_memberships_not_cached_outside_request(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        with mock.patch('ckanext.collaborators.cache.is_collaborator',
+                return_value=False) as mock_is_collaborator:
+
+            assert not cache.user_has_capacity(
+                user['id'], dataset['id'], ['editor'])
+
+            assert_equals(mock_is_collaborator.call_count, 1)
+
+    def test_no_request_store_for_command_context(self):
+
+        # Commands register a Pylons context object but no request
+        import pylons
+        pylons.tmpl_context._push_object(mock.Mock())
+        try:
+            assert_equals(cache.request_cache('memberships'), None)
+        finally:
+            pylons.tmpl_context._pop_object()
+
+    def test_owner_org_cached_per_request(self):
+
+        org = factories.Organization()
+        dataset = factories.Dataset(owner_org=org['id'])
+
+        app = self._get_test_app()
+        with app.flask_app.test_request_context():
+            with mock.patch('ckanext.collaborators.cache.dataset_owner_org',
+                    wraps=cache.dataset_owner_org) as mock_owner_org:
+
+                assert_equals(
+                    cache.get_dataset_owner_org(dataset['id']), org['id'])
+                assert_equals(
+                    cache.get_dataset_owner_org(dataset['name']), org['id'])
+
+                assert_equals(mock_owner_org.call_count, 1)
+
+    def test_owner_org_dataset_not_found(self):
+
+        assert_raises(toolkit.ObjectNotFound,
+            cache.get_dataset_owner_org, 'xxx')
+
+
+class TestLRUCache(object):
+
+    def setup(self):
+
+        self.client = fakeredis.FakeStrictRedis()
+        self.client.flushall()
+
+    def _cache(self, check_interval=5):
+        return cache.LRUCache('labels', size=2, ttl=60,
+                              check_interval=check_interval, client=self.client)
+
+    def test_get_set(self):
+
+        lru = self._cache()
+
+        value, version = lru.get('a')
+        assert_equals(value, None)
+        lru.set('a', ['label-a'], version)
+
+        assert_equals(lru.get('a')[0], ['label-a'])
+        assert_equals(lru.stats()['hits'], 1)
+        assert_equals(lru.stats()['misses'], 1)
+
+    def test_least_recently_used_evicted(self):
+
+        lru = self._cache()
+        lru.set('a', 1, 0)
+        lru.set('b', 2, 0)
+        lru.get('a')
+        lru.set('c', 3, 0)
+
+        assert_equals(lru.get('b')[0], None)
+        assert_equals(lru.get('a')[0], 1)
+        assert_equals(lru.get('c')[0], 3)
+        assert_equals(lru.stats()['evictions'], 1)
+
+    @mock.patch('ckanext.collaborators.cache.time.time')
+    def test_entries_expire(self, mock_time):
+
+        mock_time.return_value = 1000
+        lru = self._cache()
+        lru.set('a', 1, 0)
+
+        mock_time.return_value = 1061
+
+        assert_equals(lru.get('a')[0], None)
+
+    def test_invalidate_seen_by_other_workers(self):
+
+        worker1 = self._cache(check_interval=0)
+        worker2 = self._cache(check_interval=0)
+        worker2.set('a', ['label-a'], worker2.get('a')[1])
+        worker2.set('b', ['label-b'], worker2.get('b')[1])
+
+        worker1.invalidate('a')
+
+        assert_equals(worker2.get('a')[0], None)
+        assert_equals(worker2.get('b')[0], ['label-b'])
+
+    @mock.patch('ckanext.collaborators.cache.time.time')
+    def test_versions_checked_once_per_interval(self, mock_time):
+
+        mock_time.return_value = 1000
+        worker1 = self._cache()
+        worker2 = self._cache()
+        worker2.set('a', ['label-a'], worker2.get('a')[1])
+
+        with mock.patch.object(self.client, 'get',
+                               wraps=self.client.get) as mock_get:
+            # The first lookup checks the version, the next ones do not
+            for i in range(3):
+                assert_equals(worker2.get('a')[0], ['label-a'])
+            assert_equals(mock_get.call_count, 1)
+
+            worker1.invalidate('a')
+            assert_equals(worker2.get('a')[0], ['label-a'])
+
+            mock_time.return_value = 1006
+            assert_equals(worker2.get('a')[0], None)
+
+    def test_redis_errors_bypass_the_cache(self):
+
+        client = mock.Mock()
+        client.get.side_effect = Exception('Redis is down')
+        client.pipeline.side_effect = Exception('Redis is down')
+        lru = cache.LRUCache('labels', size=2, ttl=60, client=client)
+
+        value, version = lru.get('a')
+        lru.set('a', ['label-a'], version)
+        lru.invalidate('a')
+
+        assert_equals(value, None)
+        assert_equals(lru.get('a'), (None, None))
+
+    def test_value_computed_before_invalidation_not_served(self):
+
+        lru = self._cache()
+
+        _, version = lru.get('a')
+        # Invalidated while the value was being computed
+        lru.invalidate('a')
+        lru.set('a', ['label-a'], version)
+
+        assert_equals(lru.get('a')[0], None)
+
+
+class TestRedisCache(object):
+
+    def setup(self):
+
+        self.client = fakeredis.FakeStrictRedis()
+        self.client.flushall()
+
+    def test_get_set(self):
+
+        redis_cache = cache.RedisCache('labels', ttl=60, client=self.client)
+
+        value, version = redis_cache.get('a')
+        assert_equals(value, None)
+        redis_cache.set('a', ['label-a'], version)
+
+        assert_equals(redis_cache.get('a')[0], ['label-a'])
+        assert_equals(
+            self.client.ttl('ckanext-collaborators:labels:entry:a'), 60)
+
+    def test_invalidate_seen_by_other_workers(self):
+
+        worker1 = cache.RedisCache('labels', ttl=60, client=self.client)
+        worker2 = cache.RedisCache('labels', ttl=60, client=self.client)
+
+        worker1.set('a', ['label-a'], worker1.get('a')[1])
+        worker1.set('b', ['label-b'], worker1.get('b')[1])
+        assert_equals(worker2.get('a')[0], ['label-a'])
+
+        worker1.invalidate('a')
+        assert_equals(worker2.get('a')[0], None)
+        assert_equals(worker2.get('b')[0], ['label-b'])
+
+    def test_value_computed_before_invalidation_not_served(self):
+
+        worker1 = cache.RedisCache('labels', ttl=60, client=self.client)
+        worker2 = cache.RedisCache('labels', ttl=60, client=self.client)
+
+        _, version = worker1.get('a')
+        worker2.invalidate('a')
+        worker1.set('a', ['label-a'], version)
+
+        assert_equals(worker1.get('a')[0], None)
+
+    def test_clear_only_own_namespace(self):
+
+        labels = cache.RedisCache('labels', ttl=60, client=self.client)
+        other = cache.RedisCache('other', ttl=60, client=self.client)
+        labels.set('a', [], 0)
+        other.set('a', [], 0)
+
+        labels.clear()
+
+        assert_equals(labels.get('a')[0], None)
+        assert_equals(other.get('a')[0], [])
+
+
+class TestLabelsCache(FunctionalTestBase):
+
+    def _cached_labels(self, user_id):
+        return cache.labels_cache().get(user_id)[0]
+
+    def _cache_labels(self, user_id, value):
+        labels = cache.labels_cache()
+        labels.set(user_id, value, labels.get(user_id)[1])
+
+    def test_user_labels_invalidated(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        other_user = factories.User()
+        self._cache_labels(user['id'], [])
+        self._cache_labels(other_user['id'], [])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+
+        assert_equals(self._cached_labels(user['id']), None)
+        # Only the affected user is invalidated
+        assert_equals(self._cached_labels(other_user['id']), [])
+
+    def test_org_users_labels_invalidated(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        other_user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'member'}])
+        self._cache_labels(user['id'], [])
+        self._cache_labels(other_user['id'], [])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='member')
+
+        assert_equals(self._cached_labels(user['id']), None)
+        assert_equals(self._cached_labels(other_user['id']), [])
+
+    def test_removed_org_users_labels_invalidated(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'member'}])
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='member')
+
+        # Removed without going through the plugin member hooks
+        model.Session.query(model.Member).filter(
+            model.Member.group_id == org['id'],
+            model.Member.table_id == user['id']).update(
+            {'state': 'deleted'}, synchronize_session=False)
+        model.repo.commit()
+        self._cache_labels(user['id'], ['collaborator-' + dataset['id']])
+
+        cache.invalidate_member('org', org['id'])
+
+        assert_equals(self._cached_labels(user['id']), None)
+
+
+class TestAuthNotCachedAcrossRequests(FunctionalTestBase):
+
+    def test_revoked_editor_can_not_update(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+        context = {'user': user['name'], 'model': model}
+
+        assert helpers.call_auth('package_update', context, id=dataset['id'])
+
+        # Simulate a change made by another worker, which does not
+        # invalidate anything in this process
+        model.Session.query(DatasetMember).delete()
+        refresh_effective(dataset_ids=[dataset['id']])
+        model.repo.commit()
+
+        context = {'user': user['name'], 'model': model}
+        assert_raises(
+            toolkit.NotAuthorized, helpers.call_auth, 'package_update',
+            context, id=dataset['id'])
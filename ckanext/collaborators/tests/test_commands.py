@@ -0,0 +1,52 @@
+from nose.tools import assert_equals
+
+from ckan import model
+from ckan.tests import factories
+
+from ckanext.collaborators.commands import DatasetCollaborators
+from ckanext.collaborators.model import DatasetMember
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestImportCollaborators(FunctionalTestBase):
+
+    def _command(self):
+        command = DatasetCollaborators('collaborators')
+        command.options, command.args = command.parser.parse_args([])
+        return command
+
+    def test_empty_type_is_a_user(self):
+
+        dataset = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+
+        inserted, updated, errors = self._command()._import_chunk([
+            (1, {'id': dataset['id'], 'type': '', 'member_id': user1['name'],
+                 'capacity': 'editor'}),
+            (2, {'id': dataset['id'], 'type': None, 'member_id': user2['name'],
+                 'capacity': 'member'}),
+        ])
+
+        assert_equals((inserted, updated, errors), (2, 0, 0))
+        assert_equals(
+            sorted(member_id for (member_id,) in model.Session.query(
+                DatasetMember.member_id).filter(DatasetMember.type == 'user')),
+            sorted([user1['id'], user2['id']]))
+
+    def test_values_not_strings_are_row_errors(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        inserted, updated, errors = self._command()._import_chunk([
+            (1, {'id': dataset['id'], 'type': 'user', 'member_id': 42,
+                 'capacity': 'editor'}),
+            (2, {'id': dataset['id'], 'type': 'user',
+                 'member_id': user['name'], 'capacity': 1}),
+            (3, {'id': dataset['id'], 'type': 'user',
+                 'member_id': user['name'], 'capacity': 'member'}),
+        ])
+
+        assert_equals((inserted, updated, errors), (1, 0, 2))
+        assert_equals(model.Session.query(DatasetMember).count(), 1)
@@ -88,6 +88,34 @@ class TestCollaborators(helpers.FunctionalTestBase):
         assert_in('Member Collaborator', res.body)
         assert_in('<td>member</td>', res.body)
 
+    def test_user_and_org_collaborators_are_shown(self):
+        dataset = factories.Dataset(
+                private=True,
+                owner_org=self.org['id'],
+        )
+        user = factories.User(fullname='User Collaborator')
+        org = factories.Organization(title='Org Collaborator')
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='member')
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='editor')
+
+        url = toolkit.url_for('collaborators.read', dataset_id=dataset['id'])
+        app = self._get_test_app()
+        environ = {'REMOTE_USER': self.org_admin_name}
+
+        res = app.get(url, extra_environ=environ)
+
+        assert_in('1 User Collaborator and 1 Collaborator Organization',
+                  res.body)
+        assert_in('User Collaborator', res.body)
+        assert_in('Org Collaborator', res.body)
+
     def test_org_admins_can_add_collaborators(self):
         dataset = factories.Dataset(
                 private=True,
@@ -0,0 +1,125 @@
+import mock
+
+from nose.tools import assert_equals, assert_raises
+
+from ckan import model
+from ckan.plugins import toolkit
+
+from ckan.tests import helpers, factories
+
+from ckanext.collaborators import instrumentation
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestInstrument(FunctionalTestBase):
+
+    def setup(self):
+        super(TestInstrument, self).setup()
+        instrumentation.reset_stats()
+
+    def test_disabled_functions_not_wrapped(self):
+
+        functions = {'some_action': lambda context, data_dict: None}
+
+        assert instrumentation.instrument_all(functions, 'action') is functions
+
+    def test_attributes_kept(self):
+
+        @toolkit.chained_auth_function
+        def package_update(next_auth, context, data_dict):
+            return next_auth(context, data_dict)
+
+        wrapped = instrumentation.instrument(
+            'auth.package_update', package_update)
+
+        assert_equals(wrapped.__name__, 'package_update')
+        assert wrapped.chained_auth_function
+
+    def test_statements_recorded(self):
+
+        def query(count):
+            for i in range(count):
+                model.Session.execute('SELECT 1')
+
+        wrapped = instrumentation.instrument('action.query', query)
+        wrapped(2)
+        wrapped(3)
+
+        stats = instrumentation.get_stats()['action.query']
+        assert_equals(stats['calls'], 2)
+        assert_equals(stats['statements'], 5)
+        assert_equals(stats['rows'], 5)
+        assert_equals(stats['mean_statements'], 2.5)
+
+    def test_recorded_on_errors(self):
+
+        def fail():
+            raise toolkit.ValidationError({'id': 'Missing value'})
+
+        wrapped = instrumentation.instrument('action.fail', fail)
+        assert_raises(toolkit.ValidationError, wrapped)
+
+        assert_equals(instrumentation.get_stats()['action.fail']['calls'], 1)
+
+    @helpers.change_config('ckanext.collaborators.instrumentation.slow_ms', '0')
+    def test_slow_calls_logged(self):
+
+        wrapped = instrumentation.instrument('action.noop', lambda: None)
+
+        with mock.patch.object(instrumentation.log, 'warning') as warning:
+            wrapped()
+
+        assert_equals(warning.call_count, 1)
+        assert 'action.noop' in warning.call_args[0][0]
+
+
+class TestCollaboratorsStats(FunctionalTestBase):
+
+    @classmethod
+    def _apply_config_changes(cls, cfg):
+        cfg['ckanext.collaborators.instrumentation'] = True
+
+    def setup(self):
+        super(TestCollaboratorsStats, self).setup()
+        instrumentation.reset_stats()
+
+    def test_actions_and_auth_recorded(self):
+
+        user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'admin'}])
+        dataset = factories.Dataset(owner_org=org['id'])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+        toolkit.check_access(
+            'dataset_collaborator_list', {'user': user['name']},
+            {'id': dataset['id']})
+
+        result = helpers.call_action('collaborators_stats')
+
+        assert result['enabled']
+        stats = result['calls']
+        assert_equals(stats['action.dataset_collaborator_create']['calls'], 1)
+        assert stats['action.dataset_collaborator_create']['statements'] > 0
+        assert_equals(stats['auth.dataset_collaborator_list']['calls'], 1)
+
+    def test_reset(self):
+
+        helpers.call_action('collaborators_stats')
+        helpers.call_action('collaborators_stats', reset=True)
+
+        result = helpers.call_action('collaborators_stats')
+
+        assert_equals(
+            list(result['calls'].keys()), ['action.collaborators_stats'])
+
+    def test_only_sysadmins(self):
+
+        user = factories.User()
+
+        assert_raises(
+            toolkit.NotAuthorized, helpers.call_action, 'collaborators_stats',
+            context={'user': user['name'], 'ignore_auth': False})
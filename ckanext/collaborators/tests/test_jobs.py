@@ -0,0 +1,183 @@
+import json
+
+import mock
+import fakeredis
+
+from nose.tools import assert_equals
+
+from ckan.tests import helpers
+from ckan.lib.mailer import MailerException
+
+from ckanext.collaborators import jobs
+
+
+class TestNotifications(object):
+
+    def setup(self):
+
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+
+    @helpers.change_config('ckanext.collaborators.mail.retries', 2)
+    @mock.patch('ckanext.collaborators.jobs.send_notification_to_collaborator')
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_retried(self, mock_enqueue, mock_send):
+
+        mock_send.side_effect = MailerException('Error')
+
+        jobs.send_notification(
+            'dataset-id', 'user-id', 'editor', 'create', redis=self.redis)
+
+        # Queued again with the attempt count, rather than retried inline
+        assert_equals(mock_send.call_count, 1)
+        assert_equals(mock_enqueue.call_args[0][0], jobs.send_notification)
+        assert_equals(mock_enqueue.call_args[0][1],
+                      ['dataset-id', 'user-id', 'editor', 'create'])
+        assert_equals(mock_enqueue.call_args[0][2], {'attempt': 1})
+        assert_equals(jobs.failed_notifications(redis=self.redis), [])
+
+    @helpers.change_config('ckanext.collaborators.mail.retries', 2)
+    @mock.patch('ckanext.collaborators.jobs.send_notification_to_collaborator')
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_dead_letter(self, mock_enqueue, mock_send):
+
+        mock_send.side_effect = MailerException('Error')
+
+        jobs.send_notification(
+            'dataset-id', 'user-id', 'editor', 'create', redis=self.redis,
+            attempt=2)
+
+        assert_equals(mock_enqueue.call_count, 0)
+
+        failed = jobs.failed_notifications(redis=self.redis)
+        assert_equals(len(failed), 1)
+        assert_equals(failed[0]['user_id'], 'user-id')
+        assert_equals(failed[0]['error'], 'Error')
+
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_retry_failed(self, mock_enqueue):
+
+        self.redis.rpush(jobs.MAIL_FAILED_KEY, json.dumps({
+            'dataset_id': 'dataset-id', 'user_id': 'user-id',
+            'capacity': 'editor', 'event': 'delete'}))
+
+        assert_equals(jobs.retry_failed_notifications(redis=self.redis), 1)
+
+        assert_equals(mock_enqueue.call_args[0][1],
+                      ['dataset-id', 'user-id', 'editor', 'delete'])
+        assert_equals(jobs.failed_notifications(redis=self.redis), [])
+
+    @helpers.change_config('ckanext.collaborators.notifications', False)
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_notifications_disabled(self, mock_enqueue):
+
+        jobs.queue_notification('dataset-id', 'user-id', 'editor', 'create')
+
+        assert_equals(mock_enqueue.call_count, 0)
+
+
+class TestDigests(object):
+
+    def setup(self):
+
+        self.redis = fakeredis.FakeStrictRedis()
+        self.redis.flushall()
+
+    @helpers.change_config('ckanext.collaborators.notifications.digest', True)
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.digest_window', 60)
+    @mock.patch('ckanext.collaborators.jobs.time.time')
+    @mock.patch('ckanext.collaborators.jobs.send_messages')
+    @mock.patch('ckanext.collaborators.jobs.compose_digest')
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_one_digest_per_user(
+            self, mock_enqueue, mock_compose, mock_send, mock_time):
+
+        mock_compose.side_effect = lambda user_id, notifications: user_id
+        mock_send.return_value = {}
+        mock_time.return_value = 1000
+
+        jobs.queue_notification('d1', 'u1', 'editor', 'create',
+                                redis=self.redis)
+        jobs.queue_notification('d2', 'u1', 'member', 'create',
+                                redis=self.redis)
+
+        # Nothing is queued until the window has elapsed
+        assert_equals(mock_enqueue.call_count, 0)
+
+        mock_time.return_value = 1060
+        jobs.queue_notification('d1', 'u2', 'editor', 'delete',
+                                redis=self.redis)
+
+        assert_equals(mock_enqueue.call_count, 1)
+        assert_equals(mock_enqueue.call_args[0][0], jobs.send_digests)
+
+        jobs.send_digests(redis=self.redis)
+
+        composed = dict(c[0] for c in mock_compose.call_args_list)
+        assert_equals(
+            [(n['dataset_id'], n['event']) for n in composed['u1']],
+            [('d1', 'create'), ('d2', 'create')])
+        assert_equals(len(composed['u2']), 1)
+
+        # All digests sent in a single batch
+        assert_equals(mock_send.call_count, 1)
+        assert_equals(sorted(mock_send.call_args[0][0]), ['u1', 'u2'])
+
+    @helpers.change_config('ckanext.collaborators.notifications.digest', True)
+    @helpers.change_config('ckanext.collaborators.mail.retries', 1)
+    @mock.patch('ckanext.collaborators.jobs.send_messages')
+    @mock.patch('ckanext.collaborators.jobs.compose_digest')
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_failed_digests_retried_then_stored(
+            self, mock_enqueue, mock_compose, mock_send):
+
+        mock_compose.side_effect = lambda user_id, notifications: user_id
+        mock_send.side_effect = lambda messages: dict(
+            (index, MailerException('Error'))
+            for index, message in enumerate(messages) if message == 'u2')
+
+        jobs.queue_notification('d1', 'u1', 'editor', 'create',
+                                redis=self.redis)
+        jobs.queue_notification('d1', 'u2', 'editor', 'create',
+                                redis=self.redis)
+        mock_enqueue.reset_mock()
+
+        jobs.send_digests(redis=self.redis)
+
+        # Only the failed digest is queued again
+        assert_equals(mock_enqueue.call_args[0][0], jobs.send_digests)
+        retry = mock_enqueue.call_args[1]['kwargs']
+        assert_equals(retry['attempt'], 1)
+        assert_equals(list(retry['pending'].keys()), ['u2'])
+        assert_equals(jobs.failed_notifications(redis=self.redis), [])
+
+        jobs.send_digests(redis=self.redis, **retry)
+
+        assert_equals(mock_send.call_args[0][0], ['u2'])
+        assert_equals(mock_enqueue.call_count, 1)
+
+        failed = jobs.failed_notifications(redis=self.redis)
+        assert_equals([n['user_id'] for n in failed], ['u2'])
+
+    @helpers.change_config('ckanext.collaborators.notifications.digest', True)
+    @helpers.change_config(
+        'ckanext.collaborators.notifications.digest_window', 60)
+    @mock.patch('ckanext.collaborators.jobs.time.time')
+    @mock.patch('ckanext.collaborators.jobs.toolkit.enqueue_job')
+    def test_flushed_periodically(self, mock_enqueue, mock_time):
+
+        mock_time.return_value = 1000
+        jobs.queue_notification('d1', 'u1', 'editor', 'create',
+                                redis=self.redis)
+
+        mock_time.return_value = 1030
+        assert not jobs.flush_digests(redis=self.redis)
+
+        mock_time.return_value = 1060
+        assert jobs.flush_digests(redis=self.redis)
+        # Queued only once
+        assert not jobs.flush_digests(redis=self.redis)
+
+        assert_equals(mock_enqueue.call_count, 1)
+        assert_equals(mock_enqueue.call_args[0][0], jobs.send_digests)
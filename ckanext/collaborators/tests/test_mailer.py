@@ -1,17 +1,24 @@
 from nose.tools import assert_equals, assert_raises
+import smtplib
+
 import mock
 from ckan.tests import helpers, factories
 from ckan import model
 
 from ckanext.collaborators.model import DatasetMember
 from ckanext.collaborators.tests import FunctionalTestBase
-from ckanext.collaborators.mailer import mail_notification_to_collaborator
+from ckan.tests.legacy.mock_mail_server import SmtpServerHarness
+
+from ckanext.collaborators import jobs
+from ckanext.collaborators.mailer import (
+    mail_notification_to_collaborator, compose_digest, send_messages,
+    smtp_pool, Message, SMTPConnectionPool, _pipelined_sendmail)
 
 
 class TestCollaboratorsMailer(FunctionalTestBase):
 
-    @mock.patch('ckanext.collaborators.mailer.mail_user')
-    def test_email_notification_create(self, mock_mail_user):
+    @mock.patch('ckanext.collaborators.mailer.send_messages', return_value={})
+    def test_email_notification_create(self, mock_send):
         dataset = factories.Dataset()
         user = factories.User()
         capacity = 'editor' 
@@ -19,10 +26,10 @@ class TestCollaboratorsMailer(FunctionalTestBase):
         mail_notification_to_collaborator(
             dataset['id'], user['id'], capacity, 'create')
         
-        assert_equals(mock_mail_user.call_count, 1)
+        assert_equals(mock_send.call_count, 1)
 
-    @mock.patch('ckanext.collaborators.mailer.mail_user')
-    def test_email_notification_delete(self, mock_mail_user):
+    @mock.patch('ckanext.collaborators.mailer.send_messages', return_value={})
+    def test_email_notification_delete(self, mock_send):
         dataset = factories.Dataset()
         user = factories.User()
         capacity = 'editor' 
@@ -30,4 +37,131 @@ class TestCollaboratorsMailer(FunctionalTestBase):
         mail_notification_to_collaborator(
             dataset['id'], user['id'], capacity, 'delete')
         
-        assert_equals(mock_mail_user.call_count, 1)
+        assert_equals(mock_send.call_count, 1)
+
+
+class TestCollaboratorsMailDelivery(SmtpServerHarness, FunctionalTestBase):
+
+    @classmethod
+    def setup_class(cls):
+        SmtpServerHarness.setup_class()
+        FunctionalTestBase.setup_class()
+
+    @classmethod
+    def teardown_class(cls):
+        smtp_pool().clear()
+        SmtpServerHarness.teardown_class()
+        FunctionalTestBase.teardown_class()
+
+    def setup(self):
+        super(TestCollaboratorsMailDelivery, self).setup()
+        self.clear_smtp_messages()
+
+    def test_notification_job_sends_email(self):
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        jobs.send_notification(dataset['id'], user['id'], 'editor', 'create')
+
+        messages = self.get_smtp_messages()
+        assert_equals(len(messages), 1)
+        assert_equals(messages[0][2], [user['email']])
+
+    def test_send_messages(self):
+        users = [factories.User(), factories.User()]
+        dataset = factories.Dataset()
+
+        messages = [compose_digest(user['id'], [{
+            'dataset_id': dataset['id'],
+            'capacity': 'editor',
+            'event': 'create'}]) for user in users]
+
+        assert_equals(send_messages(messages), {})
+
+        sent = self.get_smtp_messages()
+        assert_equals(sorted(m[2][0] for m in sent),
+                      sorted(user['email'] for user in users))
+
+    def test_digest_skips_deleted_datasets(self):
+        user = factories.User()
+
+        assert_equals(compose_digest(user['id'], [{
+            'dataset_id': 'not-a-dataset',
+            'capacity': 'editor',
+            'event': 'create'}]), None)
+
+
+class TestSMTPConnectionPool(object):
+
+    def test_connections_reused(self):
+        pool = SMTPConnectionPool(size=1, keepalive=60, connect=mock.Mock)
+
+        connection = pool.get()
+        pool.put(connection)
+
+        assert pool.get() is connection
+        assert pool.get() is not connection
+
+    def test_idle_connections_replaced(self):
+        pool = SMTPConnectionPool(size=1, keepalive=-1, connect=mock.Mock)
+
+        connection = pool.get()
+        pool.put(connection)
+
+        assert pool.get() is not connection
+        assert_equals(connection.quit.call_count, 1)
+
+    def test_pool_size(self):
+        pool = SMTPConnectionPool(size=1, keepalive=60, connect=mock.Mock)
+
+        connections = [pool.get(), pool.get()]
+        for connection in connections:
+            pool.put(connection)
+
+        assert_equals(connections[1].quit.call_count, 1)
+
+    def test_reconnect(self):
+        broken = mock.Mock()
+        broken.has_extn.return_value = False
+        broken.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        working = mock.Mock()
+        working.has_extn.return_value = False
+
+        pool = SMTPConnectionPool(size=1, keepalive=60, connect=mock.Mock(
+            side_effect=[broken, working]))
+
+        with mock.patch('ckanext.collaborators.mailer.smtp_pool',
+                        return_value=pool):
+            errors = send_messages([
+                Message(u'User 1', 'user1@example.com', u'Subject', u'Body'),
+                Message(u'User 2', 'user2@example.com', u'Subject', u'Body'),
+            ])
+
+        assert_equals(errors, {})
+        assert_equals(working.sendmail.call_count, 2)
+        assert pool.get() is working
+
+    def test_pipelined_sendmail(self):
+        connection = mock.Mock()
+        connection.getreply.side_effect = [
+            (250, 'OK'), (250, 'OK'), (354, 'Go ahead'), (250, 'Queued')]
+
+        _pipelined_sendmail(
+            connection, 'from@example.com', ['to@example.com'], 'Body')
+
+        # Commands sent in one go, then the message
+        assert_equals(connection.send.call_count, 2)
+        assert_equals(connection.send.call_args_list[0][0][0],
+            'MAIL FROM:<from@example.com>\r\n'
+            'RCPT TO:<to@example.com>\r\n'
+            'DATA\r\n')
+        assert_equals(connection.send.call_args_list[1][0][0],
+            'Body\r\n.\r\n')
+
+    def test_pipelined_sendmail_refused(self):
+        connection = mock.Mock()
+        connection.getreply.side_effect = [
+            (250, 'OK'), (550, 'No such user'), (554, 'No recipients')]
+
+        assert_raises(smtplib.SMTPRecipientsRefused, _pipelined_sendmail,
+            connection, 'from@example.com', ['to@example.com'], 'Body')
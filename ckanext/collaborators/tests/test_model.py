@@ -0,0 +1,331 @@
+from nose.tools import assert_equals, assert_raises
+
+from sqlalchemy.exc import IntegrityError
+
+from ckan import model
+from ckan.tests import helpers, factories
+
+from ckanext.collaborators.model import (
+    DatasetMember, DatasetMemberEffective, missing_tables, missing_indexes,
+    create_indexes, duplicate_members, is_collaborator, refresh_effective, import_members,
+    export_members, orphaned_member_counts, delete_orphaned_members,
+    ResourceVisibility, resource_visibilities, sync_resource_visibility,
+    VISIBILITY_PACKAGE, VISIBILITY_EDITOR, VISIBILITY_COLLABORATOR)
+from ckanext.collaborators.tests import FunctionalTestBase
+
+
+class TestCollaboratorsModel(FunctionalTestBase):
+
+    def test_tables_and_indexes_created(self):
+
+        assert_equals(missing_tables(), [])
+        assert_equals(missing_indexes(), [])
+
+    def test_member_unique(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        for capacity in ('editor', 'member'):
+            model.Session.add(DatasetMember(
+                dataset_id=dataset['id'], type='user', member_id=user['id'],
+                capacity=capacity))
+
+        assert_raises(IntegrityError, model.Session.commit)
+
+        model.Session.rollback()
+
+        assert_equals(duplicate_members(), [])
+
+    def test_invalid_index_rebuilt(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        index_name = u'idx_dataset_member_dataset_type_member'
+
+        model.Session.execute(u'DROP INDEX {}'.format(index_name))
+        for capacity in ('editor', 'member'):
+            model.Session.add(DatasetMember(
+                dataset_id=dataset['id'], type='user', member_id=user['id'],
+                capacity=capacity))
+        model.Session.commit()
+
+        # The duplicates make the concurrent build fail, which leaves an
+        # invalid index behind
+        assert_raises(IntegrityError, create_indexes)
+        assert_equals(
+            [index.name for index in missing_indexes()], [index_name])
+
+        model.Session.query(DatasetMember).filter(
+            DatasetMember.capacity == 'member').delete()
+        model.Session.commit()
+
+        assert_equals(create_indexes(), [index_name])
+        assert_equals(missing_indexes(), [])
+
+    def test_is_collaborator(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        assert not is_collaborator(user['id'], dataset['id'], ['editor'])
+
+        model.Session.add(DatasetMember(
+            dataset_id=dataset['id'], type='user', member_id=user['id'],
+            capacity='member'))
+        refresh_effective()
+        model.Session.commit()
+
+        assert not is_collaborator(user['id'], dataset['id'], ['editor'])
+        assert is_collaborator(user['id'], dataset['id'], ['editor', 'member'])
+
+    def test_is_collaborator_org_admin_inherits_editor(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization(
+            users=[{'name': user['name'], 'capacity': 'admin'}])
+
+        model.Session.add(DatasetMember(
+            dataset_id=dataset['id'], type='org', member_id=org['id'],
+            capacity='inherit'))
+        refresh_effective()
+        model.Session.commit()
+
+        assert is_collaborator(user['id'], dataset['id'], ['editor'])
+
+
+class TestImportMembers(FunctionalTestBase):
+
+    def test_import(self):
+
+        dataset = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+        user3 = factories.User()
+
+        for user, capacity in ((user1, 'member'), (user2, 'member')):
+            model.Session.add(DatasetMember(
+                dataset_id=dataset['id'], type='user', member_id=user['id'],
+                capacity=capacity))
+        model.Session.commit()
+
+        inserted, updated = import_members([{
+            'dataset_id': dataset['id'], 'type': 'user',
+            'member_id': user['id'], 'capacity': capacity,
+        } for user, capacity in (
+            (user1, 'member'), (user2, 'editor'), (user3, 'editor'))])
+        model.Session.commit()
+
+        # user1 is unchanged
+        assert_equals((inserted, updated), (1, 1))
+
+        capacities = dict(model.Session.query(
+            DatasetMember.member_id, DatasetMember.capacity))
+        assert_equals(capacities, {
+            user1['id']: 'member',
+            user2['id']: 'editor',
+            user3['id']: 'editor',
+        })
+
+    def test_import_rolled_back(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        assert_equals(import_members([{
+            'dataset_id': dataset['id'], 'type': 'user',
+            'member_id': user['id'], 'capacity': 'editor'}]), (1, 0))
+
+        model.Session.rollback()
+
+        assert_equals(model.Session.query(DatasetMember).count(), 0)
+
+
+class TestExportMembers(FunctionalTestBase):
+
+    def test_export(self):
+
+        org = factories.Organization()
+        dataset1 = factories.Dataset(owner_org=org['id'])
+        dataset2 = factories.Dataset()
+        user = factories.User()
+        member_org = factories.Organization()
+
+        import_members([
+            {'dataset_id': dataset1['id'], 'type': 'user',
+             'member_id': user['id'], 'capacity': 'editor'},
+            {'dataset_id': dataset1['id'], 'type': 'org',
+             'member_id': member_org['id'], 'capacity': 'member'},
+            {'dataset_id': dataset2['id'], 'type': 'user',
+             'member_id': user['id'], 'capacity': 'member'},
+        ])
+        model.Session.commit()
+
+        assert_equals(len(list(export_members(batch_size=1))), 3)
+
+        rows = list(export_members(owner_org=org['id'], names=True))
+        assert_equals(
+            sorted((row.type, row.member_name, row.dataset_name)
+                   for row in rows),
+            [('org', member_org['name'], dataset1['name']),
+             ('user', user['name'], dataset1['name'])])
+
+        rows = list(export_members(
+            dataset_ids=[dataset1['id'], dataset2['id']], capacity='member',
+            member_type='user'))
+        assert_equals([row.dataset_id for row in rows], [dataset2['id']])
+
+
+class TestOrphanedMembers(FunctionalTestBase):
+
+    def test_orphans_deleted(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization()
+
+        members = [
+            (dataset['id'], 'user', user['id']),
+            (dataset['id'], 'user', 'deleted-user'),
+            (dataset['id'], 'org', org['id']),
+            (dataset['id'], 'org', 'deleted-org'),
+            ('purged-dataset', 'user', user['id']),
+        ]
+        for dataset_id, member_type, member_id in members:
+            model.Session.add(DatasetMember(
+                dataset_id=dataset_id, type=member_type, member_id=member_id,
+                capacity='member'))
+        model.Session.commit()
+
+        assert_equals(dict(orphaned_member_counts()),
+                      {'dataset': 1, 'user': 1, 'org': 1})
+
+        deleted = []
+        while True:
+            batch = delete_orphaned_members(limit=2)
+            if not batch:
+                break
+            assert len(batch) <= 2
+            deleted.extend(batch)
+        model.Session.commit()
+
+        assert_equals(
+            sorted(row[:3] for row in deleted),
+            sorted(members[1:2] + members[3:]))
+        assert_equals(
+            sorted(model.Session.query(
+                DatasetMember.dataset_id, DatasetMember.type,
+                DatasetMember.member_id)),
+            sorted(members[0:1] + members[2:3]))
+
+
+class TestEffectivePermissions(FunctionalTestBase):
+
+    def _effective(self):
+        return sorted(
+            (row.user_id, row.dataset_id, row.capacity)
+            for row in model.Session.query(DatasetMemberEffective))
+
+    def test_direct_collaborator(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='user', member_id=user['id'],
+            capacity='editor')
+
+        assert_equals(self._effective(),
+            [(user['id'], dataset['id'], 'editor')])
+
+        helpers.call_action(
+            'dataset_collaborator_delete',
+            id=dataset['id'], type='user', member_id=user['id'])
+
+        assert_equals(self._effective(), [])
+
+    def test_org_collaborator_inherit(self):
+
+        dataset = factories.Dataset()
+        user1 = factories.User()
+        user2 = factories.User()
+        org = factories.Organization(users=[
+            {'name': user1['name'], 'capacity': 'admin'},
+            {'name': user2['name'], 'capacity': 'member'},
+        ])
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='inherit')
+
+        effective = self._effective()
+        assert (user1['id'], dataset['id'], 'editor') in effective
+        assert (user2['id'], dataset['id'], 'member') in effective
+
+    def test_org_membership_changes(self):
+
+        dataset = factories.Dataset()
+        user = factories.User()
+        org = factories.Organization()
+
+        helpers.call_action(
+            'dataset_collaborator_create',
+            id=dataset['id'], type='org', member_id=org['id'],
+            capacity='editor')
+
+        assert not is_collaborator(user['id'], dataset['id'], ['editor'])
+
+        helpers.call_action(
+            'organization_member_create',
+            id=org['id'], username=user['name'], role='member')
+
+        assert is_collaborator(user['id'], dataset['id'], ['editor'])
+
+        helpers.call_action(
+            'organization_member_delete',
+            id=org['id'], username=user['name'])
+
+        assert not is_collaborator(user['id'], dataset['id'], ['editor'])
+
+
+class TestResourceVisibility(FunctionalTestBase):
+
+    def test_visibility_kept_in_sync(self):
+
+        dataset = factories.Dataset()
+        resource1 = factories.Resource(package_id=dataset['id'])
+        resource2 = factories.Resource(
+            package_id=dataset['id'], visibility='editor')
+
+        assert_equals(sorted(resource_visibilities(dataset['id'])), sorted([
+            (resource1['id'], VISIBILITY_PACKAGE),
+            (resource2['id'], VISIBILITY_EDITOR),
+        ]))
+
+        helpers.call_action('resource_patch',
+            id=resource2['id'], visibility='collaborator_member')
+
+        assert_equals(
+            model.Session.query(ResourceVisibility).one().visibility,
+            VISIBILITY_COLLABORATOR)
+
+        helpers.call_action('resource_delete', id=resource2['id'])
+
+        assert_equals(model.Session.query(ResourceVisibility).count(), 0)
+
+    def test_backfill(self):
+
+        dataset = factories.Dataset()
+        resource = factories.Resource(
+            package_id=dataset['id'], visibility='editor')
+
+        model.Session.query(ResourceVisibility).delete()
+        model.Session.commit()
+
+        assert_equals(sync_resource_visibility(), 1)
+
+        assert_equals(resource_visibilities(dataset['id']),
+            [(resource['id'], VISIBILITY_EDITOR)])